@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# anon_chat_bot is a telegram bot whose main function is to manage an
+# anonymous chat lounge
+# Copyright (C) <2020>  <jacotsu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Measures the render time and the payload size of the captcha images for
+# every supported encoding, and the cost of creating a new renderer per
+# captcha
+
+import sys
+from os.path import dirname, join, realpath
+from timeit import timeit
+
+sys.path.insert(0, join(dirname(realpath(__file__)), '..', 'src'))
+
+from captcha.image import ImageCaptcha  # noqa: E402
+from captcha_renderer import render_captcha  # noqa: E402
+
+VALUE = 'A1B2C3D4'
+RUNS = 50
+SETTINGS = [
+    ('PNG', None),
+    ('JPEG', 90),
+    ('JPEG', 75),
+    ('JPEG', 50),
+    ('WEBP', 90),
+    ('WEBP', 75),
+    ('WEBP', 50),
+]
+SIZES = [(400, 200), (300, 150), (200, 100)]
+
+
+def main():
+    width, height = SIZES[0]
+    new_renderer_time = timeit(
+        lambda: ImageCaptcha(width=width, height=height)
+        .generate(VALUE).getvalue(),
+        number=RUNS) / RUNS
+    reused_renderer_time = timeit(
+        lambda: render_captcha(VALUE, width, height), number=RUNS) / RUNS
+    print(f'New renderer per captcha: {new_renderer_time*1E3:.2f}ms, '
+          f'reused renderer: {reused_renderer_time*1E3:.2f}ms\n')
+
+    print(f'{"size":>9} {"format":>6} {"quality":>7} {"render (ms)":>11} '
+          f'{"bytes":>7}')
+    for width, height in SIZES:
+        for image_format, quality in SETTINGS:
+            kwargs = {'image_format': image_format}
+            if quality:
+                kwargs['quality'] = quality
+            payload = render_captcha(VALUE, width, height, **kwargs)
+            render_time = timeit(
+                lambda: render_captcha(VALUE, width, height, **kwargs),
+                number=RUNS) / RUNS
+            print(f'{width:>4}x{height:<4} {image_format:>6} '
+                  f'{quality or "-":>7} {render_time*1E3:>11.2f} '
+                  f'{len(payload):>7}')
+
+
+if __name__ == '__main__':
+    main()
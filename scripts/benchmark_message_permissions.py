@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# anon_chat_bot is a telegram bot whose main function is to manage an
+# anonymous chat lounge
+# Copyright (C) <2020>  <jacotsu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Compares the permission check of the MessagePermissionsFilter done by
+# building a composite telegram filter for every message with the single
+# pass classification into a bitmask of required permissions
+
+import sys
+import random
+from datetime import datetime
+from os.path import dirname, join, realpath
+from timeit import timeit
+
+sys.path.insert(0, join(dirname(realpath(__file__)), '..', 'src'))
+
+from telegram import Chat, Message, MessageEntity, PhotoSize, Sticker, \
+    Update, User  # noqa: E402
+from telegram.ext import Filters  # noqa: E402
+from permissions import Permissions  # noqa: E402
+from custom_filters import MessagePermissionsFilter  # noqa: E402
+
+ENTITY_TYPES = ['mention', 'hashtag', 'bold', 'italic', 'code', 'url',
+                'text_link', 'bot_command']
+CORPUS_SIZE = 2000
+RUNS = 5
+
+# The filters of the previous implementation
+SIMPLE_TEXT_FILTER = Filters.text
+for entity_type in ('mention', 'hashtag', 'cashtag', 'phone_number', 'email',
+                    'bold', 'italic', 'code', 'underline', 'strikethrough',
+                    'pre', 'url', 'text_link', 'text_mention'):
+    SIMPLE_TEXT_FILTER = SIMPLE_TEXT_FILTER & ~Filters.entity(entity_type)
+OLD_FILTERS = {
+    Permissions.SEND_SIMPLE_TEXT: SIMPLE_TEXT_FILTER,
+    Permissions.SEND_MENTION: Filters.entity('mention'),
+    Permissions.SEND_HASHTAG: Filters.entity('hashtag'),
+    Permissions.SEND_BOLD: Filters.entity('bold'),
+    Permissions.SEND_ITALIC: Filters.entity('italic'),
+    Permissions.SEND_CODE: Filters.entity('code'),
+    Permissions.SEND_URL: Filters.entity('url'),
+    Permissions.SEND_TEXT_LINK: Filters.entity('text_link'),
+    Permissions.SEND_PHOTO: Filters.photo,
+    Permissions.SEND_STICKER: Filters.sticker,
+    Permissions.FORWARD: Filters.forwarded
+}
+
+
+def make_update(update_id):
+    user = User(1, 'user', False)
+    chat = Chat(1, Chat.PRIVATE)
+    kwargs = {}
+    kind = random.random()
+    if kind < .6:
+        text = 'some text to relay ' * 3
+        kwargs['text'] = text
+        kwargs['entities'] = [
+            MessageEntity(random.choice(ENTITY_TYPES), 0, 4)
+            for _ in range(random.choice((0, 0, 1, 2, 3)))
+        ]
+    elif kind < .85:
+        kwargs['photo'] = [PhotoSize('file_id', 'unique_id', 10, 10)]
+    else:
+        kwargs['sticker'] = Sticker('file_id', 'unique_id', 10, 10, False)
+    if random.random() < .1:
+        kwargs['forward_date'] = datetime.now()
+    message = Message(update_id, user, datetime.now(), chat, **kwargs)
+    return Update(update_id, message=message)
+
+
+def check_with_composite_filter(update, permissions):
+    data_filter = None
+    for perm in set(OLD_FILTERS) & set(permissions):
+        if data_filter:
+            data_filter |= OLD_FILTERS[perm]
+        else:
+            data_filter = OLD_FILTERS[perm]
+    if data_filter and data_filter(update):
+        return True
+    # Find the reason of the failure
+    for data_filter in OLD_FILTERS.values():
+        if data_filter(update):
+            return False
+    return False
+
+
+def check_with_bitmask(update, permissions):
+    required = MessagePermissionsFilter.required_permissions(
+        update.effective_message)
+    return bool(required) and not required & ~int(permissions)
+
+
+def main():
+    random.seed(0)
+    corpus = [make_update(x) for x in range(CORPUS_SIZE)]
+    print(f'{"permissions":>30} {"composite (us)":>15} {"bitmask (us)":>13} '
+          f'{"speedup":>8} {"denied":>7}')
+    for name, permissions in [
+            ('all', Permissions.ALL),
+            ('text and media', Permissions.SEND_TEXT | Permissions.SEND_MEDIA |
+             Permissions.SEND_STICKER),
+            ('simple text', Permissions.SEND_SIMPLE_TEXT)]:
+        composite_time = timeit(
+            lambda: [check_with_composite_filter(x, permissions)
+                     for x in corpus],
+            number=RUNS) / RUNS / CORPUS_SIZE
+        bitmask_time = timeit(
+            lambda: [check_with_bitmask(x, permissions) for x in corpus],
+            number=RUNS) / RUNS / CORPUS_SIZE
+        denied = sum(not check_with_bitmask(x, permissions) for x in corpus)
+        print(f'{name:>30} {composite_time*1E6:>15.2f} '
+              f'{bitmask_time*1E6:>13.2f} '
+              f'{composite_time/bitmask_time:>7.1f}x {denied:>7}')
+
+
+if __name__ == '__main__':
+    main()
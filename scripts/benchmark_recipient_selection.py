@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# anon_chat_bot is a telegram bot whose main function is to manage an
+# anonymous chat lounge
+# Copyright (C) <2020>  <jacotsu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Compares the recipient selection of a broadcast done through the
+# active_users view plus one permissions query per user with the vectorized
+# selection of the in memory user state store
+
+import sys
+import random
+import sqlite3
+from os.path import dirname, join, realpath
+from timeit import timeit
+
+sys.path.insert(0, join(dirname(realpath(__file__)), '..', 'src'))
+
+from permissions import Permissions  # noqa: E402
+from user_state_store import UserStateStore  # noqa: E402
+import queries  # noqa: E402
+
+
+def populate_database(members):
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    for query in [queries.CREATE_USERS_TABLE,
+                  queries.CREATE_JOIN_LOG_TABLE,
+                  queries.CREATE_QUIT_LOG_TABLE,
+                  queries.CREATE_PERMISSIONS_TABLE,
+                  queries.CREATE_ROLES_TABLE,
+                  queries.CREATE_USER_ASSIGNED_ROLES,
+                  queries.CREATE_CAPTCHA_LOG_TABLE,
+                  queries.CREATE_BAN_LOG_TABLE,
+                  queries.CREATE_BANNED_USERS_VIEW,
+                  queries.CREATE_ACTIVE_USERS_VIEW]:
+        conn.execute(query)
+
+    user_ids = range(1, members + 1)
+    receive_only = int(Permissions.RECEIVE)
+    with conn:
+        conn.executemany('INSERT INTO users VALUES (?)',
+                         ((x,) for x in user_ids))
+        conn.executemany('INSERT INTO join_log VALUES (?, 1E6)',
+                         ((x,) for x in user_ids))
+        # A tenth of the members can't receive messages
+        conn.executemany(
+            'INSERT INTO permissions VALUES (?, ?)',
+            ((x, 0 if random.random() < .1 else receive_only)
+             for x in user_ids))
+        conn.executemany(
+            'INSERT INTO captcha_status(user_id, passed) VALUES (?, 1)',
+            ((x,) for x in user_ids))
+    return conn
+
+
+def select_with_queries(conn):
+    recipients = []
+    for row in conn.execute(queries.GET_ACTIVE_USERS):
+        perm_row = conn.execute(queries.GET_USER_PERMISSIONS,
+                                {'user_id': row['user_id']}).fetchone()
+        if Permissions.RECEIVE in Permissions(perm_row['permissions']):
+            recipients.append(row['user_id'])
+    return recipients
+
+
+def main():
+    print(f'{"members":>8} {"queries (ms)":>14} {"store (ms)":>12} '
+          f'{"speedup":>8}')
+    for members in (1000, 10000, 100000):
+        conn = populate_database(members)
+        store = UserStateStore()
+        store.load(conn.execute(queries.GET_USER_STATES))
+
+        assert sorted(select_with_queries(conn)) == \
+            sorted(store.select_active(Permissions.RECEIVE).tolist())
+
+        runs = 3
+        queries_time = timeit(lambda: select_with_queries(conn),
+                              number=runs) / runs
+        runs = 100
+        store_time = timeit(lambda: store.select_active(Permissions.RECEIVE),
+                            number=runs) / runs
+        print(f'{members:>8} {queries_time*1E3:>14.3f} '
+              f'{store_time*1E3:>12.3f} {queries_time/store_time:>7.0f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# anon_chat_bot is a telegram bot whose main function is to manage an
+# anonymous chat lounge
+# Copyright (C) <2020>  <jacotsu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# Compares the sustained send rate, the enqueue to send latency and the
+# per chat flood limit violations of PTB's MessageQueue, as configured
+# before, with the SendScheduler. Each send waits a simulated round trip
+
+import sys
+import threading
+from os.path import dirname, join, realpath
+from time import monotonic, sleep
+
+sys.path.insert(0, join(dirname(realpath(__file__)), '..', 'src'))
+
+from telegram.ext import messagequeue  # noqa: E402
+from telegram.utils.promise import Promise  # noqa: E402
+from event_bus import EventBus  # noqa: E402
+from send_scheduler import SendScheduler, TokenBucket  # noqa: E402
+
+ROUND_TRIP = .04
+CHAT_RATE = 1
+CHAT_BURST = 3
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sends = []
+
+    def send(self, chat_id, enqueued):
+        sent = monotonic()
+        sleep(ROUND_TRIP)
+        with self._lock:
+            self.sends.append((chat_id, enqueued, sent))
+
+
+def run_message_queue(workload):
+    recorder = Recorder()
+    queue = messagequeue.MessageQueue(all_burst_limit=29,
+                                      all_time_limit_ms=1017)
+    for chat_id in workload:
+        queue(Promise(recorder.send, (chat_id, monotonic()), {}), False)
+    while len(recorder.sends) < len(workload):
+        sleep(.01)
+    queue.stop()
+    return recorder.sends
+
+
+def run_send_scheduler(workload):
+    recorder = Recorder()
+    scheduler = SendScheduler(EventBus(), chat_rate=CHAT_RATE,
+                              chat_burst=CHAT_BURST)
+    for chat_id in workload:
+        scheduler.submit(chat_id, recorder.send, chat_id, monotonic())
+    scheduler.stop()
+    return recorder.sends
+
+
+def chat_violations(sends):
+    buckets = {}
+    violations = 0
+    for chat_id, _, sent in sorted(sends, key=lambda x: x[2]):
+        bucket = buckets.setdefault(chat_id,
+                                    TokenBucket(CHAT_RATE, CHAT_BURST, sent))
+        # Some slack for the timer resolution
+        if bucket.wait_time(sent) > .01:
+            violations += 1
+        bucket.take(sent)
+    return violations
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def report(name, sends, hot_chat):
+    other_sends = [x for x in sends if x[0] != hot_chat]
+    send_times = [x[2] for x in other_sends]
+    rate = (len(other_sends) - 1) / (max(send_times) - min(send_times))
+    latencies = [x[2] - x[1] for x in other_sends]
+    print(f'{name:>15} {rate:>9.1f} {percentile(latencies, .5):>9.2f} '
+          f'{percentile(latencies, .99):>9.2f} {chat_violations(sends):>11}')
+
+
+def main():
+    workloads = {
+        # A broadcast to 300 members
+        'broadcast': list(range(300)),
+        # 30 replies to a single user among a broadcast to 270 members
+        'hot chat': [-1 if x % 10 == 0 else x for x in range(300)]
+    }
+    print(f'{"round trip":>15} {ROUND_TRIP * 1E3:.0f}ms')
+    for workload_name, workload in workloads.items():
+        print(f'\n{workload_name}')
+        print(f'{"":>15} {"sends/s":>9} {"p50 (s)":>9} {"p99 (s)":>9} '
+              f'{"violations":>11}')
+        report('MessageQueue', run_message_queue(workload), -1)
+        report('SendScheduler', run_send_scheduler(workload), -1)
+    print('\nThe rates and latencies exclude the messages for the single '
+          'user')
+
+
+if __name__ == '__main__':
+    main()
@@ -21,6 +21,7 @@ setup(
         "configobj",
         "pytimeparyse",
         "captcha",
+        "numpy",
         "python_telegram_bot",
         "Telethon",
         "validate"
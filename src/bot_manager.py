@@ -19,11 +19,22 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import logging
-from telegram.ext import Updater
+from datetime import timedelta
+from queue import Queue
+from telegram import Bot
+from telegram.ext import Updater, JobQueue
+from telegram.utils.request import Request
+from pytimeparse.timeparse import timeparse
+from lane_dispatcher import LaneDispatcher
+from sender_context import SenderPrefetcher
+from update_priority import UpdatePriority, classify_update
+from catch_up import CatchUp
+from send_scheduler import SendScheduler
 from message_broker import MessageBroker
 from command_executor import CommandExecutor
 from captcha_manager import CaptchaManager
 from database import DatabaseManager
+from garbage_collector import GarbageCollector
 from custom_dataclasses import Role
 from security import load_role_users_from_config_section
 
@@ -34,16 +45,54 @@ class BotManager:
     def __init__(self, config):
         self._config = config
         self._db_man = DatabaseManager(config["Bot"]["DatabasePath"])
-        if logger.getEffectiveLevel == logging.DEBUG:
-            self._updater = Updater(config["Bot"]["Token"],
-                                    workers=1, use_context=True)
+        if logger.getEffectiveLevel() == logging.DEBUG:
+            lanes = 1
         else:
-            self._updater = Updater(config["Bot"]["Token"], use_context=True)
-        self._captcha_manager = CaptchaManager(config, self._db_man)
+            lanes = int(config["Bot"].get("Lanes", 4))
+        self._catch_up = CatchUp(self._db_man, timedelta(seconds=timeparse(
+            config["Bot"].get("CatchUpMaxAge", "5m"))))
+        sender_threads = int(config["Bot"].get("SenderThreads", 8))
+        # A connection for each lane, each sender, the updater, the job
+        # queue, the run async workers and the main thread
+        bot = Bot(config["Bot"]["Token"],
+                  request=Request(
+                      con_pool_size=lanes + sender_threads + 4 + 3))
+        dispatcher = LaneDispatcher(
+            bot,
+            Queue(),
+            job_queue=JobQueue(),
+            use_context=True,
+            lanes=lanes,
+            batch_size=int(config["Bot"].get("BatchSize", 100)),
+            prefetch=SenderPrefetcher(self._db_man),
+            priorities=UpdatePriority,
+            # The command executor is created below, the updates are
+            # classified only once the bot has started
+            classify=lambda update: classify_update(
+                self._db_man, self._cmd_executor.required_permissions,
+                update),
+            max_priority_wait=timeparse(
+                config["Bot"].get("MaxPriorityWait", "5s")),
+            admit=self._catch_up.admit
+        )
+        dispatcher.job_queue.set_dispatcher(dispatcher)
+        self._updater = Updater(workers=None, dispatcher=dispatcher,
+                                use_context=True)
+        self._captcha_manager = CaptchaManager(config, self._db_man,
+                                               dispatcher.run_in_lane)
+        self._send_scheduler = SendScheduler(
+            self._db_man.event_bus,
+            rate=float(config["Bot"].get("SendRate", 29)),
+            burst=int(config["Bot"].get("SendBurst", 1)),
+            chat_rate=float(config["Bot"].get("ChatSendRate", 1)),
+            chat_burst=int(config["Bot"].get("ChatSendBurst", 3)),
+            threads=sender_threads
+        )
         self._msg_broker = MessageBroker(self._updater,
                                          self._db_man,
                                          self._captcha_manager,
-                                         self._config)
+                                         self._config,
+                                         self._send_scheduler)
         self._cmd_executor = CommandExecutor(
             self._config,
             self._updater,
@@ -51,6 +100,20 @@ class BotManager:
             self._msg_broker,
             self._captcha_manager)
 
+        self._updater.job_queue.run_repeating(
+            lambda context: self._captcha_manager.tick(), 1)
+        self._updater.job_queue.run_repeating(
+            lambda context: self._log_backlog(), 60)
+        self._updater.job_queue.run_repeating(
+            lambda context: self._catch_up.save(dispatcher.last_update_id),
+            10)
+
+        self._garbage_collector = GarbageCollector(self._db_man, config)
+        self._updater.job_queue.run_repeating(
+            lambda context: self._garbage_collector.collect(),
+            self._garbage_collector.interval
+        )
+
         Role.init_roles_from_config(self._db_man, config)
         load_role_users_from_config_section(self._db_man, config)
 
@@ -81,12 +144,26 @@ class BotManager:
 
         self._msg_broker.broadcast_message('Bot started')
 
+    def _log_backlog(self):
+        depths = self._updater.dispatcher.priority_depths
+        if any(depths.values()):
+            logger.info('Queued updates: ' + ', '.join(
+                f'{number} {priority.name.lower()}'
+                for priority, number in depths.items()))
+        if self._send_scheduler.pending:
+            logger.info(f'Queued messages: {self._send_scheduler.pending}')
+
     def stop(self):
         '''
         Stops the bot
         '''
         self._msg_broker.broadcast_message('Bot stopped')
         self._updater.stop()
+        self._catch_up.save(self._updater.dispatcher.last_update_id)
+        # Gives the last messages, like the one above, a chance to be sent
+        self._send_scheduler.stop(timeout=10)
+        self._cmd_executor.stop()
+        self._captcha_manager.close()
         logger.info("Bot stopped")
 
     def idle(self):
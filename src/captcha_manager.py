@@ -19,14 +19,19 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import logging
-import random
-import string
+import threading
+from collections import OrderedDict, Counter
 from datetime import datetime, timedelta
+from typing import Callable
 from pytimeparse.timeparse import timeparse
-from captcha.image import ImageCaptcha
+from telegram import Message
+from telegram.error import TelegramError
 from custom_dataclasses import User
 from database import DatabaseManager
 from custom_exceptions import MaxCaptchaTriesError, CaptchaFloodError
+from captcha_strategies import CAPTCHA_STRATEGIES
+from storm_guard import StormGuard
+from event_bus import StormEnded
 
 
 logger = logging.getLogger(__name__)
@@ -59,7 +64,8 @@ def kick_user_and_raise_max_tries(user: User):
 
 
 class CaptchaManager:
-    def __init__(self, config, database_manager: DatabaseManager):
+    def __init__(self, config, database_manager: DatabaseManager,
+                 run_in_lane: Callable = None):
         action_map = {
             'kick': lambda x, y: kick_user_and_raise_max_tries(x),
             'ban': ban_user_and_raise_max_tries,
@@ -90,22 +96,112 @@ class CaptchaManager:
 
         self.max_tries = int(self._config["Captcha"]["MaxCaptchaTries"])
 
-        self._last_attempt_dict = {}
-
-    def start_captcha_session(self, user: User):
-        captcha_status = user.captcha_status
-        creation_time = captcha_status.creation_time
-        now = datetime.utcnow()
-
+        mode = self._config["Captcha"].get("Mode", "image").lower()
+        try:
+            strategy_class = CAPTCHA_STRATEGIES[mode]
+        except KeyError:
+            raise ValueError('Captcha Mode must be one of '
+                             f'{", ".join(CAPTCHA_STRATEGIES)}')
+        self.strategy = strategy_class(config, database_manager)
+
+        # During a storm the captcha sessions are queued and started at a
+        # fixed rate, each user holds at most one place in the queue
+        storm_config = config.get("StormMode", {})
+        self._sessions_per_tick = int(
+            storm_config.get("CaptchasPerSecond", 5))
+        self._max_queued_sessions = int(
+            storm_config.get("MaxQueuedCaptchas", 1000))
+        self._queue_lock = threading.Lock()
+        # user_id -> message that requested the session
+        self._queued_sessions = OrderedDict()
+        self._shed = Counter()
+        # The queued sessions are started in the lanes of their users, in
+        # order with the users' updates
+        self._run_in_lane = run_in_lane or \
+            (lambda user_id, callback, *args: callback(*args))
+        self.storm_guard = StormGuard(database_manager.event_bus, config)
+        database_manager.event_bus.subscribe(StormEnded, self._report_shed)
+
+    def close(self):
+        self.strategy.close()
+
+    def is_captcha_expired(self, user: User) -> bool:
+        return datetime.utcnow() - user.captcha_status.creation_time > \
+            self.captcha_expiration_delay
+
+    def start_captcha_session(self, user: User, message: Message) -> bool:
+        '''
+        Sends a new challenge to the user if needed, otherwise the current
+        one is sent again
+        @returns True if a new challenge has been issued
+        '''
         if user.captcha_status.failed_attempts % \
            int(self._config["Captcha"]["FailuresToGenerateNewCaptcha"]) == 0 \
-           or now - creation_time > self.captcha_expiration_delay:
-            self._generate_captcha_value(user)
-
-            return self.get_captcha_image(user)
-        return None
+           or self.is_captcha_expired(user):
+            self.strategy.issue(user, message)
+            return True
+
+        self.strategy.reissue(user, message)
+        return False
+
+    def request_captcha_session(self, message: Message,
+                                user: User = None) -> bool:
+        '''
+        Starts a captcha session for the sender of the message, during a
+        storm the session is queued instead. The sender is created, if
+        needed, when the session starts
+        @returns True if a new challenge has been issued
+        '''
+        if not self.storm_guard.is_active:
+            return self.start_captcha_session(
+                user or User(self._db_man, message.from_user), message)
+
+        with self._queue_lock:
+            if message.from_user.id in self._queued_sessions or \
+               len(self._queued_sessions) >= self._max_queued_sessions:
+                self._shed['captcha_requests'] += 1
+            else:
+                self._queued_sessions[message.from_user.id] = message
+        return False
+
+    def tick(self):
+        '''
+        Updates the storm detection and hands the next queued captcha
+        sessions to the lanes of their users, meant to be run every second
+        '''
+        self.storm_guard.tick()
+        for _ in range(self._sessions_per_tick):
+            with self._queue_lock:
+                if not self._queued_sessions:
+                    return
+                _, message = self._queued_sessions.popitem(last=False)
+            self._run_in_lane(message.from_user.id,
+                              self._start_queued_session, message)
+
+    def _start_queued_session(self, message: Message):
+        user = User(self._db_man, message.from_user)
+        if user.captcha_status.passed or user.is_banned:
+            return
+        try:
+            if self.start_captcha_session(user, message):
+                logger.info(f'{user} generated captcha '
+                            f'{user.captcha_status.current_value}')
+        except TelegramError:
+            logger.exception(f'Cannot start the captcha session of {user}')
+
+    def _report_shed(self, event):
+        with self._queue_lock:
+            event.shed.update(self._shed)
+            self._shed = Counter()
 
     def submit_captcha(self, user: User, value: str):
+        '''
+        Counts an attempt of the user to answer the current challenge
+        @raises StaleCaptchaError if the answer refers to a previous challenge
+        @raises CaptchaExpiredError if the challenge has expired
+        @raises CaptchaFloodError if the user has tried too recently
+        '''
+        self.strategy.validate_answer(user, value)
         captcha_status = user.captcha_status
         last_attempt = captcha_status.last_try_time
         now = datetime.utcnow()
@@ -114,28 +210,22 @@ class CaptchaManager:
 
         if now - last_attempt > self.delay:
             captcha_status.last_try_time = now
-            if captcha_status.current_value == value.upper():
+            if self.strategy.check_answer(user, value):
                 captcha_status.failed_attempts = 0
                 captcha_status.passed = True
                 captcha_status.current_value = ''
+                captcha_status.save()
+                self.strategy.forget(user.id)
             else:
                 captcha_status.total_failed_attempts += 1
                 captcha_status.failed_attempts += 1
                 if captcha_status.failed_attempts > self.max_tries:
                     captcha_status.failed_attempts = 0
                     captcha_status.current_value = ''
+                    captcha_status.save()
+                    self.strategy.forget(user.id)
                     self.action_for_failure(user, now + self.ban_delay)
+                else:
+                    captcha_status.save()
         else:
             raise CaptchaFloodError()
-
-    def _generate_captcha_value(self, user: User, length: int = 8):
-        user.captcha_status.current_value = \
-                ''.join(random.choices(string.ascii_uppercase +
-                                       string.digits, k=length))
-        user.captcha_status.creation_time = datetime.utcnow()
-
-    def get_captcha_image(self, user: User):
-        image = ImageCaptcha(width=400, height=200)
-        logger.debug('Generate captcha image from '
-                     f'{user.captcha_status.current_value}')
-        return image.generate(user.captcha_status.current_value)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+#
+# anon_chat_bot is a telegram bot whose main function is to manage an
+# anonymous chat lounge
+# Copyright (C) <2020>  <jacotsu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# This module is imported by the captcha pool worker processes, so it must
+# not depend on the rest of the bot
+
+import threading
+from io import BytesIO
+from captcha.image import ImageCaptcha
+
+
+SUPPORTED_FORMATS = ('PNG', 'JPEG', 'WEBP')
+
+# The renderers load their fonts on first use, so every thread (and every
+# pool process) keeps its own renderers instead of creating one per captcha
+_thread_data = threading.local()
+
+
+def _get_renderer(width: int, height: int) -> ImageCaptcha:
+    try:
+        renderers = _thread_data.renderers
+    except AttributeError:
+        renderers = _thread_data.renderers = {}
+
+    try:
+        return renderers[(width, height)]
+    except KeyError:
+        renderer = renderers[(width, height)] = ImageCaptcha(width=width,
+                                                             height=height)
+        return renderer
+
+
+def render_captcha(value: str, width: int = 400, height: int = 200,
+                   image_format: str = 'PNG', quality: int = 75) -> bytes:
+    '''
+    @returns The encoded image of the captcha value. quality is ignored by
+    the PNG format
+    @raises ValueError if the image format is not supported
+    '''
+    image_format = image_format.upper()
+    if image_format not in SUPPORTED_FORMATS:
+        raise ValueError(f'Unsupported captcha image format {image_format}')
+
+    image = _get_renderer(width, height).generate_image(value)
+    out = BytesIO()
+    if image_format == 'PNG':
+        image.save(out, format=image_format)
+    else:
+        image.save(out, format=image_format, quality=quality)
+    return out.getvalue()
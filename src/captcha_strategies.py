@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+#
+# anon_chat_bot is a telegram bot whose main function is to manage an
+# anonymous chat lounge
+# Copyright (C) <2020>  <jacotsu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import hmac
+import logging
+import multiprocessing
+import random
+import secrets
+import string
+import threading
+from base64 import urlsafe_b64encode
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from hashlib import sha256
+from io import BytesIO
+from time import monotonic, time
+from pytimeparse.timeparse import timeparse
+from telegram import Message, InlineKeyboardButton, InlineKeyboardMarkup
+from captcha_renderer import render_captcha, SUPPORTED_FORMATS
+from custom_dataclasses import User
+from custom_exceptions import StaleCaptchaError, CaptchaExpiredError
+from event_bus import CaptchaPassed, CaptchaReset, StaleStateSweep
+
+
+logger = logging.getLogger(__name__)
+
+CAPTION = 'Please complete the captcha challenge'
+
+
+class CaptchaStrategy:
+    '''
+    Generates, displays and checks a kind of captcha challenge. The
+    CaptchaManager decides when a challenge must be issued and keeps track
+    of the attempts
+    '''
+    # Whether the users answer through text messages
+    accepts_text_answers = True
+    # Pattern of the callback queries answering the challenges, if any
+    callback_pattern = None
+
+    def __init__(self, config, database_manager):
+        self._config = config
+        self._db_man = database_manager
+        self._expiration_delay = timeparse(config["Captcha"]["ExpirationTime"])
+        # user_id -> (captcha value, what is needed to display it again,
+        # display time)
+        self._displayed = {}
+        for event_type in (CaptchaPassed, CaptchaReset):
+            self._db_man.event_bus.subscribe(
+                event_type, lambda event: self.forget(event.user_id))
+        self._db_man.event_bus.subscribe(StaleStateSweep, self._evict_stale)
+
+    def _evict_stale(self, event):
+        # Expired challenges are never displayed again
+        cutoff_time = time() - self._expiration_delay
+        for user_id, displayed in list(self._displayed.items()):
+            if displayed[2] < cutoff_time:
+                self._displayed.pop(user_id, None)
+                event.reclaimed['displayed_captchas'] += 1
+
+    def issue(self, user: User, message: Message):
+        '''
+        Generates a new challenge, makes it the user's current one and sends
+        it as a reply to message
+        '''
+        raise NotImplementedError
+
+    def reissue(self, user: User, message: Message):
+        '''
+        Sends again the user's current challenge, if it has already been
+        displayed
+        '''
+        try:
+            value, displayable, _ = self._displayed[user.id]
+        except KeyError:
+            return
+        if not value or value != user.captcha_status.current_value:
+            self.forget(user.id)
+        else:
+            self._display(message, displayable)
+
+    def _display(self, message: Message, displayable):
+        raise NotImplementedError
+
+    def validate_answer(self, user: User, answer: str):
+        '''
+        Checks that the answer refers to the user's current challenge,
+        before it's counted as an attempt
+        @raises StaleCaptchaError if it refers to a previous challenge
+        @raises CaptchaExpiredError if the challenge has expired
+        '''
+
+    def check_answer(self, user: User, answer: str) -> bool:
+        return user.captcha_status.current_value == answer.strip().upper()
+
+    def forget(self, user_id: int):
+        self._displayed.pop(user_id, None)
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def _set_captcha_value(user: User, value: str):
+        # Saved before being displayed, so that the answer can't come before
+        # the value is stored
+        captcha_status = user.captcha_status
+        captcha_status.current_value = value
+        captcha_status.creation_time = datetime.utcnow()
+        captcha_status.save()
+
+
+class ImageCaptchaStrategy(CaptchaStrategy):
+    '''
+    The user has to type the text shown in an image. The images are
+    displayed again through the file_id telegram assigned to them
+    '''
+    def __init__(self, config, database_manager):
+        super().__init__(config, database_manager)
+        captcha_config = self._config["Captcha"]
+        self._render_options = {
+            'width': int(captcha_config.get("Width", 400)),
+            'height': int(captcha_config.get("Height", 200)),
+            'image_format': captcha_config.get("ImageFormat", "PNG").upper(),
+            'quality': int(captcha_config.get("ImageQuality", 75))
+        }
+        if self._render_options['image_format'] not in SUPPORTED_FORMATS:
+            raise ValueError('Captcha ImageFormat must be one of '
+                             f'{", ".join(SUPPORTED_FORMATS)}')
+
+        # Pre-rendered (value, image bytes) pairs, refilled in background by
+        # a process pool so that rendering doesn't hold the workers' GIL
+        self._pool_size = int(captcha_config.get("PoolSize", 32))
+        self._pool = deque()
+        self._pool_lock = threading.Lock()
+        self._pending_renders = 0
+        # Cancelled when the pool is closed
+        self._pending_futures = set()
+        # Seconds between the submission and the completion of the last
+        # renders
+        self._refill_latencies = deque(maxlen=100)
+        self._executor = None
+        if self._pool_size > 0:
+            self._executor = ProcessPoolExecutor(
+                int(captcha_config.get("PoolWorkers", 2)),
+                mp_context=multiprocessing.get_context('spawn')
+            )
+            self._refill_pool()
+
+    @property
+    def pool_depth(self) -> int:
+        '''
+        Number of ready captchas
+        '''
+        return len(self._pool)
+
+    @property
+    def refill_latency(self) -> float:
+        '''
+        Mean time in seconds taken by the last renders of the pool
+        '''
+        if not self._refill_latencies:
+            return 0.
+        return sum(self._refill_latencies) / len(self._refill_latencies)
+
+    def _refill_pool(self):
+        with self._pool_lock:
+            missing = self._pool_size - len(self._pool) - \
+                self._pending_renders
+            if missing <= 0 or not self._executor:
+                return
+            self._pending_renders += missing
+
+        for _ in range(missing):
+            value = self._random_captcha_value()
+            submission_time = monotonic()
+            try:
+                future = self._executor.submit(render_captcha, value,
+                                               **self._render_options)
+            except RuntimeError:
+                # The pool has been closed
+                with self._pool_lock:
+                    self._pending_renders = 0
+                return
+            with self._pool_lock:
+                self._pending_futures.add(future)
+            future.add_done_callback(
+                lambda f, v=value, t=submission_time:
+                self._on_captcha_rendered(f, v, t)
+            )
+
+    def _on_captcha_rendered(self, future, value: str,
+                             submission_time: float):
+        with self._pool_lock:
+            self._pending_renders -= 1
+            self._pending_futures.discard(future)
+        if future.cancelled() or future.exception():
+            if not future.cancelled():
+                logger.error(f'Captcha rendering failed: '
+                             f'{future.exception()}')
+            return
+
+        self._refill_latencies.append(monotonic() - submission_time)
+        self._pool.append((value, future.result()))
+
+    def close(self):
+        '''
+        Stops the pool's worker processes
+        '''
+        if self._executor:
+            executor, self._executor = self._executor, None
+            # shutdown cancels the pending futures only since python 3.9
+            with self._pool_lock:
+                pending_futures = list(self._pending_futures)
+            for future in pending_futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    @staticmethod
+    def _random_captcha_value(length: int = 8) -> str:
+        return ''.join(random.choices(string.ascii_uppercase +
+                                      string.digits, k=length))
+
+    def issue(self, user: User, message: Message):
+        try:
+            value, image = self._pool.popleft()
+        except IndexError:
+            logger.debug('The captcha pool is empty')
+            value = self._random_captcha_value()
+            image = render_captcha(value, **self._render_options)
+        self._refill_pool()
+        self._set_captcha_value(user, value)
+
+        sent_msg = message.reply_photo(BytesIO(image),
+                                       caption=f'{CAPTION} (no spaces)')
+        self._displayed[user.id] = (value, sent_msg.photo[-1].file_id, time())
+
+    def _display(self, message: Message, file_id: str):
+        message.reply_photo(file_id, caption=f'{CAPTION} (no spaces)')
+
+
+class ArithmeticCaptchaStrategy(CaptchaStrategy):
+    '''
+    The user has to type the result of a short arithmetic operation
+    '''
+    OPERATIONS = {
+        '+': lambda x, y: x + y,
+        '-': lambda x, y: x - y,
+        '×': lambda x, y: x * y
+    }
+
+    def issue(self, user: User, message: Message):
+        operator = random.choice(list(self.OPERATIONS))
+        a = random.randint(1, 10 if operator == '×' else 50)
+        b = random.randint(1, 10 if operator == '×' else 50)
+        value = str(self.OPERATIONS[operator](a, b))
+        self._set_captcha_value(user, value)
+
+        question = f'{CAPTION}: how much is {a} {operator} {b}?'
+        message.reply_text(question)
+        self._displayed[user.id] = (value, question, time())
+
+    def _display(self, message: Message, question: str):
+        message.reply_text(question)
+
+
+class KeyboardCaptchaStrategy(CaptchaStrategy):
+    '''
+    The user has to press the button with the requested symbol.
+    The callback data carries the creation time of the challenge, which
+    tells the presses on old keyboards apart, and the right button an HMAC
+    of the user, the creation time, the option and the symbol, the wrong
+    ones random bytes of the same length
+    '''
+    accepts_text_answers = False
+    callback_pattern = r'^captcha\|'
+    SYMBOLS = ['🍎', '🍌', '🍒', '🍇', '🍋', '🍉', '🍓', '🍍', '🥝', '🥕',
+               '🌽', '🍄']
+    # Bytes of the truncated HMAC, the callback data can be at most 64 bytes
+    SIGNATURE_LENGTH = 12
+
+    def __init__(self, config, database_manager):
+        super().__init__(config, database_manager)
+        captcha_config = self._config["Captcha"]
+        secret = captcha_config.get("CallbackSecret", "")
+        # Without a configured secret the pending challenges don't survive
+        # a restart
+        self._secret = secret.encode() if secret else secrets.token_bytes(32)
+        self._options_no = min(int(captcha_config.get("KeyboardOptions", 6)),
+                               len(self.SYMBOLS))
+
+    def _sign(self, user_id: int, nonce: int, option: int,
+              symbol: str) -> str:
+        signature = hmac.new(
+            self._secret,
+            f'{user_id}|{nonce}|{option}|{symbol}'.encode(),
+            sha256
+        ).digest()[:self.SIGNATURE_LENGTH]
+        return urlsafe_b64encode(signature).decode()
+
+    @staticmethod
+    def _nonce(user: User) -> int:
+        # The creation time is stored with a resolution of one second
+        return int(user.captcha_status.creation_time
+                   .replace(tzinfo=timezone.utc).timestamp())
+
+    def issue(self, user: User, message: Message):
+        options = random.sample(self.SYMBOLS, self._options_no)
+        right_option = random.randrange(self._options_no)
+        self._set_captcha_value(user, options[right_option])
+
+        nonce = self._nonce(user)
+        buttons = []
+        for i, symbol in enumerate(options):
+            if i == right_option:
+                signature = self._sign(user.id, nonce, i, symbol)
+            else:
+                signature = urlsafe_b64encode(
+                    secrets.token_bytes(self.SIGNATURE_LENGTH)).decode()
+            buttons.append(InlineKeyboardButton(
+                symbol,
+                callback_data=f'captcha|{user.id}|{nonce}|{i}|{signature}'
+            ))
+        displayable = (
+            f'{CAPTION}: press {options[right_option]}',
+            InlineKeyboardMarkup([buttons[i:i+3]
+                                  for i in range(0, len(buttons), 3)])
+        )
+        self._display(message, displayable)
+        self._displayed[user.id] = (options[right_option], displayable,
+                                    time())
+
+    def _display(self, message: Message, displayable):
+        text, keyboard = displayable
+        message.reply_text(text, reply_markup=keyboard)
+
+    def validate_answer(self, user: User, answer: str):
+        try:
+            prefix, user_id, nonce, _, _ = answer.split('|')
+            nonce = int(nonce)
+            is_current = prefix == 'captcha' and int(user_id) == user.id
+        except ValueError:
+            is_current = False
+        if not is_current or not user.captcha_status.current_value or \
+           nonce != self._nonce(user):
+            raise StaleCaptchaError()
+        if nonce + self._expiration_delay < time():
+            raise CaptchaExpiredError()
+
+    def check_answer(self, user: User, answer: str) -> bool:
+        try:
+            _, _, nonce, option, signature = answer.split('|')
+            expected_signature = self._sign(
+                user.id, int(nonce), int(option),
+                user.captcha_status.current_value)
+        except ValueError:
+            return False
+        return hmac.compare_digest(signature, expected_signature)
+
+
+CAPTCHA_STRATEGIES = {
+    'image': ImageCaptchaStrategy,
+    'arithmetic': ArithmeticCaptchaStrategy,
+    'keyboard': KeyboardCaptchaStrategy
+}
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+#
+# anon_chat_bot is a telegram bot whose main function is to manage an
+# anonymous chat lounge
+# Copyright (C) <2020>  <jacotsu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import logging
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from telegram import Update
+from telegram.ext import Filters
+
+
+logger = logging.getLogger(__name__)
+
+# The updates fetched by the last getUpdates call before the bot stopped are
+# delivered again if the call wasn't confirmed, telegram returns up to 100
+# updates per call
+MAX_REDELIVERED_UPDATES = 100
+
+
+class CatchUp:
+    '''
+    Filters the updates received after a restart. The updates that were
+    already processed before the bot stopped are dropped, and until the
+    bot has caught up with the backlog the chat messages older than max_age
+    aren't relayed. Commands and the messages of the users that haven't
+    passed the captcha, like the captcha answers, are always processed.
+    The id of the last processed update is kept in the database_info table
+    '''
+    def __init__(self, database_manager, max_age: timedelta):
+        self._db_man = database_manager
+        self._max_age = max_age
+        try:
+            self._saved_update_id = self._db_man.get_last_update_id()
+        except ValueError:
+            self._saved_update_id = 0
+        # The updates up to this one were processed before the restart
+        self._restart_update_id = self._saved_update_id
+        self.active = True
+        # Both kinds are there from the start, so that the save job can copy
+        # the counter while the dispatcher updates it
+        self.skipped = Counter(relays=0, processed_updates=0)
+        self._logged_skipped = self.skipped.copy()
+
+    def admit(self, update) -> bool:
+        '''
+        @returns False if the update must be dropped
+        '''
+        if not isinstance(update, Update):
+            return True
+        if self._restart_update_id:
+            # After a week without updates telegram picks the next update
+            # id at random, so only the ids just before the saved one are
+            # treated as already processed, until a new one is received
+            if 0 <= self._restart_update_id - update.update_id < \
+                    MAX_REDELIVERED_UPDATES:
+                self.skipped['processed_updates'] += 1
+                return False
+            self._restart_update_id = 0
+        if not self.active:
+            return True
+
+        message = update.effective_message
+        if not message or not message.date:
+            return True
+        is_old = datetime.now(timezone.utc) - message.date > self._max_age
+        if not is_old:
+            self._end()
+        elif update.message and not Filters.command(update) and \
+                self._has_passed_captcha(update.message.from_user):
+            self.skipped['relays'] += 1
+            return False
+        return True
+
+    def _has_passed_captcha(self, tg_user) -> bool:
+        if not tg_user:
+            return True
+        try:
+            return self._db_man.get_user_state(tg_user.id)['captcha_passed']
+        except ValueError:
+            return False
+
+    def save(self, last_update_id: int):
+        '''
+        Saves the id of the last processed update, if it has changed, and
+        logs the updates skipped since the last call
+        '''
+        self._log_skipped()
+        if last_update_id and last_update_id != self._saved_update_id:
+            self._db_man.set_last_update_id(last_update_id)
+            self._saved_update_id = last_update_id
+
+    def _end(self):
+        self.active = False
+        self._log_skipped(always=True)
+
+    def _log_skipped(self, always: bool = False):
+        skipped = self.skipped.copy()
+        if not any(skipped.values()) or \
+           (skipped == self._logged_skipped and not always):
+            return
+        self._logged_skipped = skipped
+        state = 'Catching up' if self.active else 'Caught up'
+        logger.info(f'{state} with the pending updates, skipped '
+                    f'{skipped["relays"]} relays of old chat messages and '
+                    f'{skipped["processed_updates"]} already processed '
+                    'updates')
@@ -22,7 +22,9 @@
 import logging
 import sys
 import dateparser
-from telegram.ext import CommandHandler
+from telegram import Update
+from telegram.ext import MessageHandler, TypeHandler, Filters
+from pytimeparse.timeparse import timeparse
 from telegram.constants import MAX_MESSAGE_LENGTH
 from utils import log_action, chunk_string, \
     get_permissions_from_config_section, create_and_register_poll,\
@@ -31,7 +33,9 @@ from security import is_hierarchy_respected,\
     is_role_hierarchy_respected
 from custom_logging import user_log_str
 from custom_filters import ActiveUsersFilter, UnbannedUsersFilter,\
-        PassedCaptchaFilter, AntiFloodFilter, CommandPermissionsFilter
+        PassedCaptchaFilter, AntiFloodFilter
+from sender_context import get_sender_context
+from filter_chain import FilterChain
 from database import DatabaseManager
 from user_resolver import UserResolver
 from custom_exceptions import UserResolverError
@@ -57,27 +61,39 @@ class CommandExecutor:
         self._captcha_manager = captcha_manager
         self._usr_resolver = UserResolver(database_manager, config)
 
-        authed_user_filters = ActiveUsersFilter(self._db_man) &\
-            UnbannedUsersFilter(self._db_man, self._msg_broker) &\
-            AntiFloodFilter(self._db_man, config, self._msg_broker) &\
+        # The captcha filter comes last, so that it doesn't take commands
+        # of banned or flooding users as captcha answers
+        self._authed_user_filters = FilterChain(
+            [
+                ActiveUsersFilter(self._db_man),
+                UnbannedUsersFilter(self._db_man, self._msg_broker)
+            ],
+            AntiFloodFilter(self._db_man, config, self._msg_broker),
             PassedCaptchaFilter(self._db_man,
                                 self._captcha_manager,
                                 config,
                                 self._msg_broker)
+        )
+        authed_user_filters = self._authed_user_filters
 
         self.commands = {
             'join': {
                 'description': 'Join the chat',
                 'permissions_required': Permissions.NONE,
                 'usage': '/join',
-                'filters': UnbannedUsersFilter(self._db_man) &
-                AntiFloodFilter(self._db_man, config, self._msg_broker) &
-                PassedCaptchaFilter(
-                    self._db_man,
-                    self._captcha_manager,
-                    config,
-                    self._msg_broker
-                ) & ~ActiveUsersFilter(self._db_man),
+                'filters': FilterChain(
+                    [
+                        UnbannedUsersFilter(self._db_man),
+                        ~ActiveUsersFilter(self._db_man)
+                    ],
+                    AntiFloodFilter(self._db_man, config, self._msg_broker),
+                    PassedCaptchaFilter(
+                        self._db_man,
+                        self._captcha_manager,
+                        config,
+                        self._msg_broker
+                    )
+                ),
                 'callback': self.join
             },
             'quit': {
@@ -307,12 +323,12 @@ class CommandExecutor:
             },
 
             'view_user_info': {
-                'description': 'Shows the info of a user. '
+                'description': 'Shows the info of one or more users. '
                 'if no username or user_id is specified, this command must '
                 'be issued as a reply',
                 'permissions_required': Permissions.SEND_CMD |
                 Permissions.VIEW_USER_INFO,
-                'usage': '/view_user_info [username/user id]',
+                'usage': '/view_user_info [username/user id], ...',
                 'filters': authed_user_filters,
                 'callback': self.view_user_info
             },
@@ -337,18 +353,32 @@ class CommandExecutor:
             }
         }
 
-        cmd_filter = CommandPermissionsFilter(self._db_man,
-                                              self.commands)
+        # Plain int masks are faster than Permissions in the bitwise checks
+        self._required_permissions = {
+            cmd_name: int(cmd_dict['permissions_required'])
+            for cmd_name, cmd_dict in self.commands.items()
+        }
 
         message_dispatcher = updater.dispatcher
 
-        for cmd_name, cmd_dict in self.commands.items():
-            message_dispatcher.add_handler(
-                CommandHandler(cmd_name,
-                               cmd_dict['callback'],
-                               filters=cmd_dict['filters'] & cmd_filter)
-            )
-            logger.debug(f'Registered {cmd_name}: {cmd_dict["callback"]}')
+        # Every update feeds the local user index, the negative group makes
+        # the observer run before (and independently from) the other handlers
+        message_dispatcher.add_handler(
+            TypeHandler(Update, self._usr_resolver.observe_update),
+            group=-1
+        )
+        updater.job_queue.run_repeating(
+            lambda context: self._usr_resolver.user_index.flush(),
+            timeparse(config['UsernameResolver'].get('IndexFlushInterval',
+                                                     '10s'))
+        )
+
+        # A single handler routes all the commands
+        message_dispatcher.add_handler(
+            MessageHandler(Filters.command & Filters.update.messages,
+                           self._route_command)
+        )
+        logger.debug(f'Registered {", ".join(self.commands)}')
 
         bot = updater.bot
 
@@ -361,6 +391,62 @@ class CommandExecutor:
                                      self.commands.items()))
         bot.set_my_commands([*public_commands])
 
+    def stop(self):
+        '''
+        Flushes the observed users and releases the user resolver
+        '''
+        self._usr_resolver.user_index.flush()
+        self._usr_resolver.close()
+
+    def required_permissions(self, cmd_name: str) -> int:
+        '''
+        @returns The permissions mask required by the command
+        @raises KeyError if the command doesn't exist
+        '''
+        return self._required_permissions[cmd_name]
+
+    def _route_command(self, update, context):
+        '''
+        Parses the command, runs its filters and checks its permissions once,
+        then dispatches it to its callback
+        '''
+        message = update.effective_message
+        # /command@bot_username args
+        cmd_name, _, bot_username = \
+            message.text[1:message.entities[0].length].partition('@')
+        if bot_username and \
+           bot_username.lower() != context.bot.username.lower():
+            return
+        cmd_name = cmd_name.lower()
+
+        cmd_dict = self.commands.get(cmd_name)
+        if cmd_dict:
+            cmd_filters = cmd_dict['filters']
+        else:
+            cmd_filters = self._authed_user_filters
+        if not cmd_filters(update):
+            return
+
+        sender = get_sender_context(self._db_man, update)
+        if not cmd_dict:
+            self._msg_broker.send_or_forward_msg(sender.user,
+                                                 'Unknown command')
+            return
+
+        if self._required_permissions[cmd_name] & \
+           ~int(sender.permissions):
+            self._msg_broker.send_or_forward_msg(
+                sender.user,
+                'You do not have the necessary permissions to execute this '
+                'command'
+            )
+            logger.warning(f'{sender.user} has tried to execute {cmd_name} '
+                           'without the appropriate permissions')
+            return
+
+        context.args = message.text.split()[1:]
+        cmd_dict['callback'](update, context)
+
     # General commands
     @log_action(logger)
     def join(self, update, context):
@@ -735,7 +821,9 @@ class CommandExecutor:
             user_to_waive_captcha = self._usr_resolver\
                 .acquire_target_user_from_cmd(update)
             if is_hierarchy_respected(admin_user, user_to_waive_captcha):
-                user_to_waive_captcha.captcha_status.passed = True
+                captcha_status = user_to_waive_captcha.captcha_status
+                captcha_status.passed = True
+                captcha_status.save()
 
                 self._msg_broker.send_or_forward_msg(
                     admin_user,
@@ -772,8 +860,10 @@ class CommandExecutor:
                 .acquire_target_user_from_cmd(update)
 
             if is_hierarchy_respected(admin_user, user_to_reset_captcha):
-                user_to_reset_captcha.captcha_status.passed = False
-                user_to_reset_captcha.captcha_status.failed_attempts = 0
+                captcha_status = user_to_reset_captcha.captcha_status
+                captcha_status.passed = False
+                captcha_status.failed_attempts = 0
+                captcha_status.save()
 
                 self._msg_broker.send_or_forward_msg(
                     admin_user,
@@ -817,7 +907,7 @@ class CommandExecutor:
                             f'Role {role_name} already exists'
                         )
                     )
-                elif role_power > admin_user.role.power:
+                elif role_power > admin_user.power:
                     self._msg_broker.send_or_forward_msg(
                         admin_user,
                         'You cannot create role whose power is higher than '
@@ -982,8 +1072,8 @@ class CommandExecutor:
                 try:
                     new_power = int(split_cmd[1])
                     # Only admins with higher power than set a role as default
-                    if admin_user.role.power > role.power:
-                        if 0 <= new_power < admin_user.role.power:
+                    if admin_user.power > role.power:
+                        if 0 <= new_power < admin_user.power:
                             role.power = new_power
                             self._msg_broker.send_or_forward_msg(
                                 admin_user,
@@ -1035,7 +1125,7 @@ class CommandExecutor:
             if self._db_man.does_role_exist(split_cmd[0]):
                 role_to_delete = Role(self._db_man, split_cmd[0])
                 # Only admins with higher power than set a role as default
-                if admin_user.role.power > role_to_delete.power:
+                if admin_user.power > role_to_delete.power:
                     self._msg_broker.send_or_forward_msg(
                         admin_user,
                         escape_markdown_chars(
@@ -1164,34 +1254,51 @@ class CommandExecutor:
     @log_action(logger)
     def view_user_info(self, update, context):
         admin_user = User(self._db_man, update.message.from_user)
-        try:
-            user = self._usr_resolver.acquire_target_user_from_cmd(update)
-            join_log_str = escape_markdown_chars(
-                "\n".join(map(lambda x: str(x), user.join_quit_log))
-            )
-            ban_log_str = escape_markdown_chars(
-                "\n".join(map(lambda x: str(x), user.ban_log))
-            )
-            msg = '*User info*\n'\
-                f'*First name*: {escape_markdown_chars(user.first_name)}\n'\
-                f'*Last name*: {escape_markdown_chars(user.last_name)}\n'\
-                f'*Username*: @{escape_markdown_chars(user.username)}\n'\
-                f'*ID*: {user.id}\n'\
-                f'*Role*: {escape_markdown_chars(str(user.role))}\n'\
-                '*Permissions*: '\
-                f'{escape_markdown_chars(str(user.permissions))}\n'\
-                f'*Join log*: \n{join_log_str}\n'\
-                f'*Ban log*: \n{ban_log_str}\n'
+        split_cmd = split_cmd_line(update.message.text)
+        if not update.message.reply_to_message and len(split_cmd) > 1:
+            # Many targets are resolved at once, like resolve_many the
+            # empty ones (e.g. after a trailing comma) are skipped
+            targets = [x.strip() for x in split_cmd if x.strip()]
+            users = self._usr_resolver.resolve_many(targets)
+        else:
+            targets = ['']
+            try:
+                users = [
+                    self._usr_resolver.acquire_target_user_from_cmd(update)
+                ]
+            except (ValueError, UserResolverError) as e:
+                users = [e]
+
+        for target, user in zip(targets, users):
+            if isinstance(user, Exception):
+                msg = escape_markdown_chars(
+                    f'{target}: {user}' if target else str(user))
+            else:
+                msg = self._get_user_info_msg(user)
 
             self._msg_broker.send_or_forward_msg(
                 admin_user,
                 msg
             )
-        except (ValueError, UserResolverError) as e:
-            self._msg_broker.send_or_forward_msg(
-                admin_user,
-                escape_markdown_chars(str(e))
-            )
+
+    @staticmethod
+    def _get_user_info_msg(user: User) -> str:
+        join_log_str = escape_markdown_chars(
+            "\n".join(map(lambda x: str(x), user.join_quit_log))
+        )
+        ban_log_str = escape_markdown_chars(
+            "\n".join(map(lambda x: str(x), user.ban_log))
+        )
+        return '*User info*\n'\
+            f'*First name*: {escape_markdown_chars(user.first_name)}\n'\
+            f'*Last name*: {escape_markdown_chars(user.last_name)}\n'\
+            f'*Username*: @{escape_markdown_chars(user.username)}\n'\
+            f'*ID*: {user.id}\n'\
+            f'*Role*: {escape_markdown_chars(str(user.role))}\n'\
+            '*Permissions*: '\
+            f'{escape_markdown_chars(str(user.permissions))}\n'\
+            f'*Join log*: \n{join_log_str}\n'\
+            f'*Ban log*: \n{ban_log_str}\n'
 
     @log_action(logger)
     def set_banner(self, update, context):
@@ -114,8 +114,22 @@ class BanLogEntry:
 
 @dataclass
 class CaptchaStatus:
+    '''
+    The captcha state of a user. It's loaded with a single query, modified
+    in memory and written back at once by save()
+    '''
     _db_man: 'database.DatabaseManager'
-    _user: 'User'
+    user_id: int
+    failed_attempts: int = 0
+    total_failed_attempts: int = 0
+    passed: bool = False
+    creation_time: datetime = datetime.utcfromtimestamp(0)
+    last_try_time: datetime = datetime.utcfromtimestamp(0)
+    current_value: str = ''
+
+    def __post_init__(self):
+        # Used to publish the passed/reset events only on changes
+        self._saved_passed = self.passed
 
     def __str__(self):
         attribute_values = [
@@ -131,81 +145,29 @@ class CaptchaStatus:
 
         return f'{self.__class__}({attribute_values})'
 
-    def __init__(self,
-                 database_manager: 'database.DatabaseManager',
-                 user: 'User'):
-        self._db_man = database_manager
-        self._user = user
-        logger.debug(f'Initializing CaptchaStatus for {user}')
+    @classmethod
+    def load(cls, database_manager: 'database.DatabaseManager',
+             user_id: int) -> 'CaptchaStatus':
+        '''
+        @returns The stored captcha status of the user, or a default one if
+        the user has none
+        '''
         try:
-            self.failed_attempts
+            return database_manager.get_captcha_status(user_id)
         except ValueError:
-            logger.debug(f'No data available for {user}, setting default'
-                         'values')
-            self.failed_attempts = 0
-            self.total_failed_attempts = 0
-            self.passed = False
-            self.creation_time = datetime.utcfromtimestamp(0)
-            self.last_try_time = datetime.utcfromtimestamp(0)
-            self.current_value = ''
-        logger.debug(f'Initialized CaptchaStatus for {user}')
-
-    @property
-    def failed_attempts(self) -> int:
-        return self._db_man.\
-                get_user_failed_attempts_from_captcha_status(self._user.id)
-
-    @failed_attempts.setter
-    def failed_attempts(self, failed_attempts_no: int):
-        self._db_man.set_user_failed_attempts_from_captcha_status(
-            self._user.id, failed_attempts_no)
-
-    @property
-    def total_failed_attempts(self) -> int:
-        return self._db_man.get_user_total_failed_attempts_from_captcha_status(
-            self._user.id)
-
-    @total_failed_attempts.setter
-    def total_failed_attempts(self, total_failed_attempts_no: int):
-        self._db_man.set_user_total_failed_attempts_from_captcha_status(
-            self._user.id, total_failed_attempts_no)
-
-    @property
-    def passed(self) -> bool:
-        return self._db_man.get_user_passed_from_captcha_status(self._user.id)
+            logger.debug(f'No captcha data available for {user_id}, using '
+                         'default values')
+            captcha_status = cls(database_manager, user_id)
+            # A new status is always written, even if not passed
+            captcha_status._saved_passed = None
+            return captcha_status
 
-    @passed.setter
-    def passed(self, passed: int = 0):
-        self._db_man.set_user_passed_from_captcha_status(self._user.id, passed)
-
-    @property
-    def creation_time(self) -> datetime:
-        return self._db_man.get_user_current_captcha_creation_time_date(
-            self._user.id)
-
-    @creation_time.setter
-    def creation_time(self, creation_timedate: datetime = datetime.utcnow()):
-        return self._db_man.set_user_current_captcha_creation_time_date(
-            self._user.id, creation_timedate)
-
-    @property
-    def last_try_time(self) -> datetime:
-        return self._db_man.get_user_current_captcha_last_try_time_date(
-            self._user.id)
-
-    @last_try_time.setter
-    def last_try_time(self, last_try_timedate: datetime = datetime.utcnow()):
-        return self._db_man.set_user_current_captcha_last_try_time_date(
-            self._user.id, last_try_timedate)
-
-    @property
-    def current_value(self) -> str:
-        return self._db_man.get_user_current_captcha_value(self._user.id)
-
-    @current_value.setter
-    def current_value(self, value: str) -> str:
-        return self._db_man.set_user_current_captcha_value(self._user.id,
-                                                           value)
+    def save(self):
+        self._db_man.save_captcha_status(
+            self,
+            passed_changed=self.passed != self._saved_passed
+        )
+        self._saved_passed = self.passed
 
 
 @dataclass
@@ -221,6 +183,7 @@ class User:
                  role_name_or_role: 'Role' = 'default'
                  ):
         self._db_man = db_man
+        self._captcha_status = None
         self.first_name = ''
         self.last_name = ''
         self.username = ''
@@ -257,7 +220,7 @@ class User:
             elif isinstance(role_name_or_role, Role):
                 self.role = role_name_or_role
             self.permissions = permissions
-            self.captcha_status
+            self.captcha_status.save()
 
     def __str__(self):
         data = {
@@ -275,7 +238,12 @@ class User:
 
     @property
     def captcha_status(self) -> CaptchaStatus:
-        return CaptchaStatus(self._db_man, self)
+        '''
+        Loaded on first access, call its save method to persist the changes
+        '''
+        if self._captcha_status is None:
+            self._captcha_status = CaptchaStatus.load(self._db_man, self.id)
+        return self._captcha_status
 
     @property
     def permissions(self) -> Permissions:
@@ -299,7 +267,7 @@ class User:
 
     @chat_delay.setter
     def chat_delay(self, delta: timedelta):
-        if delta > 0:
+        if delta > timedelta(0):
             self._db_man.set_user_chat_delay(self.id, delta)
         else:
             raise ValueError(f'The chat delay delta must be > 0 ({delta})')
@@ -312,6 +280,13 @@ class User:
     def role(self, new_role: Role):
         self._db_man.set_user_role(self.id, new_role.name)
 
+    @property
+    def power(self) -> int:
+        '''
+        The power of the user's role
+        '''
+        return self._db_man.get_user_role_power(self.id)
+
     @property
     def join_quit_log(self) -> Iterable[DateInterval]:
         return self._db_man.get_join_quit_log(self.id)
@@ -337,7 +312,7 @@ class User:
         self._db_man.kick_user(self.id)
 
     def reset_chat_delay(self):
-        self._db_man.reset_chat_delay(self.id)
+        self._db_man.reset_user_chat_delay(self.id)
 
     # Quit is basically the same as kicking
     def quit(self):
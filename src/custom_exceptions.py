@@ -42,5 +42,13 @@ class CaptchaFloodError(Exception):
     pass
 
 
+class StaleCaptchaError(Exception):
+    pass
+
+
+class CaptchaExpiredError(Exception):
+    pass
+
+
 class InvalidPermissionsError(Exception):
     pass
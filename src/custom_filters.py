@@ -21,23 +21,31 @@
 
 import logging
 from telegram.ext.filters import BaseFilter
-from telegram.ext import Filters
 from telegram import Update, Message
 from permissions import Permissions
-from datetime import datetime, timedelta
+from datetime import timedelta
 from pytimeparse.timeparse import timeparse
 from captcha_manager import CaptchaManager
 from custom_exceptions import MaxCaptchaTriesError, CaptchaFloodError,\
     InvalidPermissionsError
-from custom_dataclasses import User
 from custom_logging import user_log_str
 from misc import user_join
+from sender_context import get_sender_context
+from rate_limiter import RateLimiter
+from notice_registry import NoticeRegistry
+from event_bus import UserBanned, UserUnbanned, CaptchaPassed, CaptchaReset
 
 
 logger = logging.getLogger(__name__)
 
 
 class MessageBrokeredFilter(BaseFilter):
+    '''
+    A filter that notifies the senders of the rejected messages. The check
+    has no side effects, the notices are sent by notify_rejection, which
+    FilterChain calls with the same argument as the check once the filter
+    has rejected it
+    '''
     def __init__(self, database_manager, message_broker=None, *args, **kwargs):
         self._db_man = database_manager
         self._msg_broker = message_broker
@@ -49,16 +57,53 @@ class MessageBrokeredFilter(BaseFilter):
         elif isinstance(update_or_message, Message):
             message = update_or_message
 
-        user = User(self._db_man, message.from_user)
+        user = get_sender_context(self._db_man, message).user
         if self._msg_broker:
             self._msg_broker.send_or_forward_msg(user, msg)
         else:
             update_or_message.reply_text(msg)
 
-
-class AnonPollFilter(Filters._Poll):
-    def filter(self, message):
-        return super().filter(message) and bool(message.poll.is_anonymous)
+    def notify_rejection(self, update_or_message):
+        pass
+
+
+# Message classification tables of the MessagePermissionsFilter, plain ints
+# are faster than Permissions in the bitwise operations
+_ENTITY_PERMISSIONS = {
+    'mention': int(Permissions.SEND_MENTION),
+    'hashtag': int(Permissions.SEND_HASHTAG),
+    'cashtag': int(Permissions.SEND_CASHTAG),
+    'phone_number': int(Permissions.SEND_PHONE_NUMBER),
+    'email': int(Permissions.SEND_EMAIL),
+    'bold': int(Permissions.SEND_BOLD),
+    'italic': int(Permissions.SEND_ITALIC),
+    'code': int(Permissions.SEND_CODE),
+    'underline': int(Permissions.SEND_UNDERLINE),
+    'strikethrough': int(Permissions.SEND_STRIKETHROUGH),
+    'pre': int(Permissions.SEND_CODE_BLOCK),
+    'url': int(Permissions.SEND_URL),
+    'text_link': int(Permissions.SEND_TEXT_LINK),
+    'text_mention': int(Permissions.SEND_TEXT_MENTION)
+}
+
+# Animations are sent as documents too, so they need both permissions
+_ATTACHMENT_PERMISSIONS = (
+    ('animation', int(Permissions.SEND_ANIMATION)),
+    ('photo', int(Permissions.SEND_PHOTO)),
+    ('contact', int(Permissions.SEND_CONTACT)),
+    ('dice', int(Permissions.SEND_DICE)),
+    ('document', int(Permissions.SEND_DOCUMENT)),
+    ('location', int(Permissions.SEND_LOCATION)),
+    ('video', int(Permissions.SEND_VIDEO)),
+    ('video_note', int(Permissions.SEND_VIDEO_NOTE)),
+    ('audio', int(Permissions.SEND_AUDIO)),
+    ('voice', int(Permissions.SEND_VOICE)),
+    ('sticker', int(Permissions.SEND_STICKER))
+)
+
+_SIMPLE_TEXT = int(Permissions.SEND_SIMPLE_TEXT)
+_ANON_POLL = int(Permissions.SEND_ANON_POLL)
+_FORWARD = int(Permissions.FORWARD)
 
 
 class AntiFloodFilter(MessageBrokeredFilter):
@@ -67,52 +112,33 @@ class AntiFloodFilter(MessageBrokeredFilter):
         self._default_time_delta = timedelta(seconds=timeparse(
             config["AntiFlood"]["MinimumDelayBetweenMessages"]
         ))
-        self._last_message_dict = {}
-        self._cleanup_time_delta = timedelta(hours=1)
-        self._inactivity_cleanup_time_delta = timedelta(minutes=10)
-        self._last_cleanup_time = datetime.utcnow()
+        self._rate_limiter = RateLimiter(
+            database_manager.event_bus,
+            int(config["AntiFlood"].get("Burst", 1))
+        )
+        self._notices = NoticeRegistry(database_manager.event_bus)
+        self._notices.register_kind('antiflood')
 
     def filter(self, message):
-        user = User(self._db_man, message.from_user)
-        now = datetime.utcnow()
-
-        if now - self._last_cleanup_time > self._cleanup_time_delta:
-            self._last_message_dict = {
-                user_id: data for (user_id, data) in
-                self._last_message_dict.items()
-                if now - data['last_msg_time'] <
-                self._inactivity_cleanup_time_delta
-            }
+        sender = get_sender_context(self._db_man, message)
 
-        if Permissions.BYPASS_ANTIFLOOD in user.permissions:
+        if Permissions.BYPASS_ANTIFLOOD in sender.permissions:
             return True
 
-        try:
-            delay = user.chat_delay
-        except ValueError:
-            delay = self._default_time_delta
-
-        try:
-            elapsed_time = now - \
-                    self._last_message_dict[user.id]['last_msg_time']
-            if elapsed_time > delay:
-                # sent_warning is necessary to avoid a DOS by malicious
-                # users that try to flood anyway
-                self._last_message_dict[user.id] = {
-                    'last_msg_time': now,
-                    'sent_warning': False
-                }
-                return True
-        except KeyError:
-            self._last_message_dict[user.id] = {
-                'last_msg_time': now,
-                'sent_warning': False
-            }
+        delay = sender.chat_delay or self._default_time_delta
+        wait_time = self._rate_limiter.acquire(
+            message.from_user.id,
+            delay // timedelta(microseconds=1) * 1000
+        )
+        if not wait_time:
             return True
 
-        if not self._last_message_dict[user.id]['sent_warning']:
-            logger.warning(f'{user} is trying to flood the chat')
-            self.send_message(message, f'You must wait {delay - elapsed_time} '
+        wait_time = timedelta(microseconds=wait_time // 1000)
+        # A single warning until the user can write again
+        if self._notices.may_notify('antiflood', message.from_user.id,
+                                    wait_time):
+            logger.warning(f'{sender.user} is trying to flood the chat')
+            self.send_message(message, f'You must wait {wait_time} '
                               'before sending another message or command')
         return False
 
@@ -125,13 +151,13 @@ class ActiveUsersFilter(BaseFilter):
         self._db_man = database_manager
 
     def filter(self, message):
-        user = User(self._db_man, message.from_user)
-        if user.is_active:
+        sender = get_sender_context(self._db_man, message)
+        if sender.is_active:
             return True
 
         logger.debug(
-            f'{user}\'s Message ({message}) was filtered because he\'s '
-            'not active'
+            f'{user_log_str(message)} Message ({message}) was filtered '
+            'because he\'s not active'
         )
         return False
 
@@ -142,54 +168,29 @@ class UnbannedUsersFilter(MessageBrokeredFilter):
     '''
     def __init__(self, database_manager, message_broker=None):
         super().__init__(database_manager, message_broker)
-        self._db_man = database_manager
         # We only send the message once, to avoid spambots that would saturate
         # our message bandwidth
-        self._sent_warnings = {}
+        self._notices = NoticeRegistry(database_manager.event_bus)
+        self._notices.register_kind('ban')
+        # A new ban deserves a new warning
+        for event_type in (UserBanned, UserUnbanned):
+            self._db_man.event_bus.subscribe(event_type, self._forget_user)
+
+    def _forget_user(self, event):
+        self._notices.forget('ban', event.user_id)
 
     def filter(self, message):
-        user = User(self._db_man, message.from_user)
-        if not user.is_banned:
-            return True
+        return not get_sender_context(self._db_man, message).is_banned
+
+    def notify_rejection(self, message):
+        user = get_sender_context(self._db_man, message).user
 
         logger.debug(
             f'banned user {user} has tried to use the bot'
         )
 
-        if not self._sent_warnings[user.id]:
+        if self._notices.may_notify('ban', user.id):
             self.send_message(message, 'You have been banned from the bot')
-            self._sent_warnings[user.id] = True
-        return False
-
-
-class CommandPermissionsFilter(MessageBrokeredFilter):
-    def __init__(self, database_manager, command_dicts, message_broker=None):
-        super().__init__(database_manager, message_broker)
-        self._command_dicts = command_dicts
-
-    def filter(self, message):
-        user = User(self._db_man, message.from_user)
-        try:
-            # Take the first word an drop the initial slash
-            cmd = message.text.split()[0][1:]
-            cmd_dict = self._command_dicts[cmd]
-            if cmd_dict['permissions_required'] in user.permissions:
-                return True
-            else:
-                self.send_message(
-                    message,
-                    'You do not have the necessary permissions '
-                    'to execute this command'
-                )
-                logger.warning(f'{user} has tried to execute {cmd} without '
-                               'the appropriate permissions')
-        except (KeyError, IndexError):
-
-            self.send_message(
-                message,
-                'Unknown command'
-            )
-        return False
 
 
 class MessagePermissionsFilter(MessageBrokeredFilter):
@@ -202,207 +203,170 @@ class MessagePermissionsFilter(MessageBrokeredFilter):
     def __init__(self, database_manager, message_broker=None):
         super().__init__(database_manager, message_broker)
 
-        self._filter_map = {
+        self._denial_map = {
             Permissions.SEND_SIMPLE_TEXT: {
-                'filter':
-                Filters.text & ~Filters.entity('mention') &
-                ~Filters.entity('hashtag') & ~Filters.entity('cashtag') &
-                ~Filters.entity('phone_number') & ~Filters.entity('email') &
-                ~Filters.entity('bold') & ~Filters.entity('italic') &
-                ~Filters.entity('code') & ~Filters.entity('underline') &
-                ~Filters.entity('strikethrough') & ~Filters.entity('pre') &
-                ~Filters.entity('url') & ~Filters.entity('text_link') &
-                ~Filters.entity('text_mention'),
                 'user_msg': 'You cannot send messages',
                 'log_msg': '{user_log_str} has tried to send a message'
                            'with invalid permissions ({user_perm}) '
                            '{message}'
             },
             Permissions.SEND_MENTION: {
-                'filter': Filters.entity('mention'),
                 'user_msg': 'You cannot mention people',
                 'log_msg': '{user_log_str} has tried to mention a user'
                            'with invalid permissions ({user_perm}) '
                            '{message}'
             },
             Permissions.SEND_HASHTAG: {
-                'filter': Filters.entity('hashtag'),
                 'user_msg': 'You cannot send hashtags',
                 'log_msg': '{user_log_str} has tried to send an '
                            'hashtag with invalid permissions '
                            '({user_perm}) {message}'
             },
             Permissions.SEND_CASHTAG: {
-                'filter': Filters.entity('cashtag'),
                 'user_msg': 'You cannot send chashtags',
                 'log_msg': '{user_log_str} has tried to send a '
                            'chashtag with invalid permissions '
                            '({user_perm}) {message}'
             },
             Permissions.SEND_PHONE_NUMBER: {
-                'filter': Filters.entity('phone_number'),
                 'user_msg': 'You cannot send phone numbers',
                 'log_msg': '{user_log_str} has tried to send a '
                            'phone number with invalid permissions '
                            '({user_perm}) {message}'
             },
             Permissions.SEND_EMAIL: {
-                'filter': Filters.entity('email'),
                 'user_msg': 'You cannot send email addresses',
                 'log_msg': '{user_log_str} has tried to send an '
                            'email address with invalid permissions '
                            '({user_perm}) {message}'
             },
             Permissions.SEND_BOLD: {
-                'filter': Filters.entity('bold'),
                 'user_msg': 'You cannot send bold text',
                 'log_msg': '{user_log_str} has tried to send '
                            'bold text with invalid permissions '
                            '({user_perm}) {message}'
             },
             Permissions.SEND_ITALIC: {
-                'filter': Filters.entity('italic'),
                 'user_msg': 'You cannot send italic text',
                 'log_msg': '{user_log_str} has tried to send '
                            'italic text with invalid permissions '
                            '({user_perm}) {message}'
             },
             Permissions.SEND_CODE: {
-                'filter': Filters.entity('code'),
                 'user_msg': 'You cannot send code',
                 'log_msg': '{user_log_str} has tried to send '
                            'code with invalid permissions '
                            '({user_perm}) {message}'
             },
             Permissions.SEND_UNDERLINE: {
-                'filter': Filters.entity('underline'),
                 'user_msg': 'You cannot send underlined text',
                 'log_msg': '{user_log_str} has tried to send '
                            'underlined text with invalid permissions '
                            '({user_perm}) {message}'
             },
             Permissions.SEND_STRIKETHROUGH: {
-                'filter': Filters.entity('strikethrough'),
                 'user_msg': 'You cannot send strikethrough text',
                 'log_msg': '{user_log_str} has tried to send '
                            'strikethrough text with invalid permissions '
                            '({user_perm}) {message}'
             },
             Permissions.SEND_CODE_BLOCK: {
-                'filter': Filters.entity('pre'),
                 'user_msg': 'You cannot send code blocks',
                 'log_msg': '{user_log_str} has tried to send a '
                            'code block with invalid permissions '
                            '({user_perm}) {message}'
             },
             Permissions.SEND_URL: {
-                'filter': Filters.entity('url'),
                 'user_msg': 'You cannot send urls',
                 'log_msg': '{user_log_str} has tried to send a '
                            'url with invalid permissions '
                            '({user_perm}) {message}'
             },
             Permissions.SEND_TEXT_LINK: {
-                'filter': Filters.entity('text_link'),
                 'user_msg': 'You cannot send text links',
                 'log_msg': '{user_log_str} has tried to send a '
                            'text link with invalid permissions '
                            '({user_perm}) {message}'
             },
             Permissions.SEND_TEXT_MENTION: {
-                'filter': Filters.entity('text_mention'),
                 'user_msg': 'You cannot send text mentions',
                 'log_msg': '{user_log_str} has tried to send a '
                            'text mention with invalid permissions '
                            '({user_perm}) {message}'
             },
             Permissions.SEND_ANIMATION: {
-                'filter': Filters.animation,
                 'user_msg': 'You cannot send animations',
                 'log_msg': '{user_log_str} has tried to send an '
                            'animation with invalid permissions '
                            '({user_perm}) {message}'
             },
             Permissions.SEND_PHOTO: {
-                'filter': Filters.photo,
                 'user_msg': 'You cannot send photos',
                 'log_msg': '{user_log_str} has tried to send a '
                            'photo with invalid permissions '
                            '({user_perm}) {message}'
             },
             Permissions.SEND_CONTACT: {
-                'filter': Filters.contact,
                 'user_msg': 'You cannot send contacts',
                 'log_msg': '{user_log_str} has tried to send a '
                            'contact with invalid permissions '
                            '({user_perm}) {message}'
             },
             Permissions.SEND_DICE: {
-                'filter': Filters.dice,
                 'user_msg': 'You cannot send dices/targets',
                 'log_msg': '{user_log_str} has tried to send a '
                            'dice/target with invalid permissions '
                            '({user_perm}) {message}'
             },
             Permissions.SEND_DOCUMENT: {
-                # Mimetype filtering is possible, but unneeded right now
-                'filter': Filters.document,
                 'user_msg': 'You cannot send documents',
                 'log_msg': '{user_log_str} has tried to send a '
                            'document with invalid permissions '
                            '({user_perm}) {message}'
             },
             Permissions.SEND_LOCATION: {
-                'filter': Filters.location,
                 'user_msg': 'You cannot send locations',
                 'log_msg': '{user_log_str} has tried to send a '
                            'location with invalid permissions '
                            '({user_perm}) {message}'
             },
             Permissions.SEND_VIDEO: {
-                'filter': Filters.video,
                 'user_msg': 'You cannot send videos',
                 'log_msg': '{user_log_str} has tried to send a '
                            'video with invalid permissions '
                            '({user_perm}) {message}'
             },
             Permissions.SEND_VIDEO_NOTE: {
-                'filter': Filters.video_note,
                 'user_msg': 'You cannot send video notes',
                 'log_msg': '{user_log_str} has tried to send a '
                            'video note with invalid permissions '
                            '({user_perm}) {message}'
             },
             Permissions.SEND_AUDIO: {
-                'filter': Filters.audio,
                 'user_msg': 'You cannot send audios',
                 'log_msg': '{user_log_str} has tried to send an '
                            'audio with invalid permissions '
                            '({user_perm}) {message}'
             },
             Permissions.SEND_VOICE: {
-                'filter': Filters.voice,
                 'user_msg': 'You cannot send voice notes',
                 'log_msg': '{user_log_str} has tried to send a '
                            'voice note with invalid permissions '
                            '({user_perm}) {message}'
             },
             Permissions.SEND_STICKER: {
-                'filter': Filters.sticker,
                 'user_msg': 'You cannot send stickers',
                 'log_msg': '{user_log_str} has tried to send a '
                            'sticker with invalid permissions '
                            '({user_perm}) {message}'
             },
             Permissions.SEND_ANON_POLL: {
-                'filter': AnonPollFilter(),
                 'user_msg': 'You cannot send polls',
                 'log_msg': '{user_log_str} has tried to send a '
                            'poll with invalid permissions '
                            '({user_perm}) {message}'
             },
             Permissions.FORWARD: {
-                'filter': Filters.forwarded,
                 'user_msg': 'You cannot forward messages',
                 'log_msg': '{user_log_str} has tried to forward a '
                            'message with invalid permissions '
@@ -410,32 +374,50 @@ class MessagePermissionsFilter(MessageBrokeredFilter):
             }
         }
 
-    def filter(self, update):
-        user = User(self._db_man, update.message.from_user)
-        data_filter = None
-
-        for perm in set(self._filter_map) & set(user.permissions):
-            perm_data = self._filter_map[perm]
-            if data_filter:
-                data_filter |= perm_data['filter']
-            else:
-                data_filter = perm_data['filter']
-
-        if data_filter and data_filter(update):
-            return True
+    @staticmethod
+    def required_permissions(message: Message) -> int:
+        '''
+        Classifies the message in a single pass over its entities and
+        attachments
+        @returns The bitmask of the permissions needed to send the message,
+        0 if the message type is unsupported
+        '''
+        required = 0
+        for entity in message.entities:
+            required |= _ENTITY_PERMISSIONS.get(entity.type, 0)
+        if message.text and not required:
+            required = _SIMPLE_TEXT
+        for attachment, permission in _ATTACHMENT_PERMISSIONS:
+            if getattr(message, attachment):
+                required |= permission
+        if message.poll and message.poll.is_anonymous:
+            required |= _ANON_POLL
+        if message.forward_date:
+            required |= _FORWARD
+        return required
 
-        for perm, data in self._filter_map.items():
-            if data['filter'](update):
-                self.send_message(update, data['user_msg'])
-                logger.debug(data['log_msg'].format(
-                    user_log_str=user,
-                    user_perm=user.permissions,
-                    message=update.message
-                ))
-                return False
-
-        self.send_message(update, 'Unsupported message type')
-        return False
+    def filter(self, update):
+        required = self.required_permissions(update.effective_message)
+        sender = get_sender_context(self._db_man, update)
+        return bool(required) and not required & ~int(sender.permissions)
+
+    def notify_rejection(self, update):
+        message = update.effective_message
+        required = self.required_permissions(message)
+        if not required:
+            self.send_message(update, 'Unsupported message type')
+            return
+
+        sender = get_sender_context(self._db_man, update)
+        missing = required & ~int(sender.permissions)
+        # Report the lowest missing permission
+        data = self._denial_map[Permissions(missing & -missing)]
+        self.send_message(update, data['user_msg'])
+        logger.debug(data['log_msg'].format(
+            user_log_str=sender.user,
+            user_perm=sender.permissions,
+            message=message
+        ))
 
 
 class PassedCaptchaFilter(MessageBrokeredFilter):
@@ -447,17 +429,43 @@ class PassedCaptchaFilter(MessageBrokeredFilter):
     def __init__(self, database_manager, captcha_manager, config,
                  message_broker=None):
         super().__init__(database_manager, message_broker)
-        self._last_attempt_dict = {}
         self._captcha_manager = captcha_manager
         self._config = config
+        # Past the delay between attempts the warning is sent again anyway
+        self._notices = NoticeRegistry(database_manager.event_bus)
+        self._notices.register_kind('captcha_flood', captcha_manager.delay)
+        for event_type in (CaptchaPassed, CaptchaReset):
+            self._db_man.event_bus.subscribe(event_type, self._forget_user)
+
+    def _forget_user(self, event):
+        self._notices.forget('captcha_flood', event.user_id)
 
     def filter(self, update):
-        user = User(self._db_man, update.from_user)
-        if user.captcha_status.passed:
-            return True
+        return get_sender_context(self._db_man, update).captcha_passed
+
+    def notify_rejection(self, update):
+        '''
+        Checks the answer to the current challenge, if any, otherwise starts
+        a captcha session
+        '''
+        sender = get_sender_context(self._db_man, update)
+        storm_guard = self._captcha_manager.storm_guard
+        storm_guard.record_unverified_update()
+        if storm_guard.is_active and not sender.is_known:
+            # New users are created once their captcha session starts
+            self._captcha_manager.request_captcha_session(update)
+            return
+        user = sender.user
 
         # Proceed with captcha verification
-        if user.captcha_status.current_value:
+        strategy = self._captcha_manager.strategy
+        if user.captcha_status.current_value and \
+           not strategy.accepts_text_answers:
+            # The challenge is answered elsewhere, a new one is sent only
+            # when the current one expires
+            if not self._captcha_manager.is_captcha_expired(user):
+                return
+        elif user.captcha_status.current_value:
             try:
                 self._captcha_manager.submit_captcha(
                     user,
@@ -466,7 +474,7 @@ class PassedCaptchaFilter(MessageBrokeredFilter):
                 if user.captcha_status.passed:
                     logger.info(f'{user} has passed the captcha challenge')
                     user_join(user, self._config, self._msg_broker)
-                    return False
+                    return
                 else:
                     self.send_message(update, 'Wrong captcha')
                     max_tries = self._captcha_manager\
@@ -478,36 +486,16 @@ class PassedCaptchaFilter(MessageBrokeredFilter):
             except MaxCaptchaTriesError as e:
                 self.send_message(update, e.reason)
             except CaptchaFloodError:
-                try:
-                    if self._last_attempt_dict[user.id]['sent_warning']:
-                        logger.info(f'{user} is flooding the captcha')
-                    else:
-                        self.send_message(
-                            update,
-                            'You can try once every '
-                            f'{self._captcha_manager.delay}'
-                        )
-                except KeyError:
+                if self._notices.may_notify('captcha_flood', user.id):
                     self.send_message(
                         update,
                         'You can try once every '
                         f'{self._captcha_manager.delay}'
                     )
-                finally:
-                    self._last_attempt_dict[user.id] = {
-                        'sent_warning': True
-                    }
-                    return False
-        captcha_img = self._captcha_manager.start_captcha_session(user)
-        if captcha_img:
+                else:
+                    logger.info(f'{user} is flooding the captcha')
+                return
+        if self._captcha_manager.request_captcha_session(update, user):
             logger.info(f'{user} generated captcha '
                         f'{user.captcha_status.current_value}')
-            update.reply_photo(
-                captcha_img,
-                caption='Please complete the captcha challenge '
-                '(no spaces)'
-            )
-            self._last_attempt_dict[user.id] = {
-                'sent_warning': False
-            }
-        return False
+            self._notices.forget('captcha_flood', user.id)
@@ -18,6 +18,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import json
 import sqlite3
 import threading
 import logging
@@ -27,6 +28,11 @@ from telegram import Message
 import queries
 import custom_dataclasses
 from permissions import Permissions
+from user_state_store import UserStateStore
+from role_table import RoleTable
+from event_bus import EventBus, UserCreated, UserJoined, UserQuit,\
+    UserBanned, UserUnbanned, PermissionsChanged, RoleChanged,\
+    CaptchaPassed, CaptchaReset, RoleEdited, ChatDelayChanged
 from utils import SingletonDecorator
 
 
@@ -43,8 +49,47 @@ class DatabaseManager:
         self._db_path = db_path
         self._conn = {}
         self._get_connection()
+        self._event_bus = EventBus()
+        self._user_state_store = UserStateStore()
+        self._user_state_store.load(
+            self._execute_simple_get_query(queries.GET_USER_STATES))
+        self._rebuild_role_table()
+        self._subscribe_caches()
         logger.debug("Database initialized!")
 
+    @property
+    def event_bus(self) -> EventBus:
+        '''
+        The bus on which the DatabaseManager publishes the state changes,
+        events are always published after the change has been committed
+        '''
+        return self._event_bus
+
+    def _subscribe_caches(self):
+        '''
+        Keeps the in memory user state store and role table in sync with the
+        database
+        '''
+        store = self._user_state_store
+        subscriptions = [
+            (UserCreated, lambda x: store.upsert(x.user_id)),
+            (UserJoined, lambda x: store.set_member(x.user_id, True)),
+            (UserQuit, lambda x: store.set_member(x.user_id, False)),
+            # Bans and roles effects are computed by the database
+            (UserBanned, lambda x: self._sync_user_state(x.user_id)),
+            (UserUnbanned, lambda x: self._sync_user_state(x.user_id)),
+            (RoleChanged, lambda x: self._sync_user_state(x.user_id)),
+            (PermissionsChanged,
+             lambda x: store.set_permissions(x.user_id, x.permissions)),
+            (CaptchaPassed,
+             lambda x: store.set_captcha_passed(x.user_id, True)),
+            (CaptchaReset,
+             lambda x: store.set_captcha_passed(x.user_id, False)),
+            (RoleEdited, self._on_role_edited)
+        ]
+        for event_type, callback in subscriptions:
+            self._event_bus.subscribe(event_type, callback)
+
     def _get_connection(self):
         try:
             return self._conn[threading.get_ident()]
@@ -61,9 +106,13 @@ class DatabaseManager:
                     queries.CREATE_USER_ASSIGNED_ROLES,
                     queries.CREATE_CAPTCHA_LOG_TABLE,
                     queries.CREATE_ACTIVE_CAPTCHA_TABLE,
+                    queries.CREATE_ACTIVE_CAPTCHA_CREATION_TIME_INDEX,
                     queries.CREATE_BAN_LOG_TABLE,
                     queries.CREATE_CHAT_DELAYS_TABLE,
                     queries.CREATE_MESSAGES_TABLE,
+                    queries.CREATE_USER_RESOLVER_CACHE_TABLE,
+                    queries.CREATE_OBSERVED_USERS_TABLE,
+                    queries.CREATE_OBSERVED_USERS_USERNAME_INDEX,
                     queries.CREATE_DATABASE_INFO_TABLE,
                     queries.SET_DATABASE_VERSION
                 ]
@@ -128,14 +177,41 @@ class DatabaseManager:
         )
         return row
 
-    def get_active_users(self):
+    def _sync_user_state(self, user_id: int):
         '''
-        @returns An iterable of User instances
+        Reloads the user's row of the in memory user state store, used after
+        writes whose effects are computed by the database (triggers, bans)
         '''
-        logger.debug('Getting active users')
-        cursor = self._execute_simple_get_query(queries.GET_ACTIVE_USERS)
-        return map(lambda x: custom_dataclasses.User(self, x['user_id']),
-                   cursor)
+        self._user_state_store.load(
+            self._execute_simple_get_query(queries.GET_USER_STATE,
+                                           {'user_id': user_id}))
+
+    def get_active_users(self,
+                         permissions: Permissions = Permissions.NONE):
+        '''
+        @returns An iterable of User instances whose permissions include the
+        specified ones
+        '''
+        logger.debug(f'Getting active users with {permissions}')
+        user_ids = self._user_state_store.select_active(permissions)
+        return map(lambda x: custom_dataclasses.User(self, int(x)),
+                   user_ids)
+
+    def get_user_state(self, user_id: int) -> dict:
+        '''
+        @returns The user's state from the in memory user state store, see
+        UserStateStore.get_state
+        @raises ValueError if the user doesn't exist
+        '''
+        try:
+            return self._user_state_store.get_state(user_id)
+        except KeyError:
+            self._sync_user_state(user_id)
+        try:
+            return self._user_state_store.get_state(user_id)
+        except KeyError:
+            raise ValueError(f'User id: {user_id} is not present in the '
+                             'users database')
 
     def get_user(self, user_id):
         '''
@@ -155,6 +231,9 @@ class DatabaseManager:
             self.get_user_permissions(user_id))
 
     def user_exists(self, user_id):
+        # Users are never deleted, so the store can't return false positives
+        if user_id in self._user_state_store:
+            return True
         try:
             row = self._execute_get_query_for_1_row(
                 queries.DOES_USER_EXIST,
@@ -190,6 +269,7 @@ class DatabaseManager:
             queries.CREATE_USER,
             {'user_id': user_id}
         )
+        self._event_bus.publish(UserCreated(user_id))
         logger.debug(f'Created user {user_id}')
 
     def log_join(self, user_id: int,
@@ -202,6 +282,7 @@ class DatabaseManager:
              'unix_join_date': int(date_time.replace(tzinfo=timezone.utc)
                                    .timestamp())}
         )
+        self._event_bus.publish(UserJoined(user_id))
 
     def log_quit(self, user_id,
                  date_time: datetime = None):
@@ -213,6 +294,7 @@ class DatabaseManager:
              'unix_quit_date': int(date_time.replace(tzinfo=timezone.utc)
                                    .timestamp())}
         )
+        self._event_bus.publish(UserQuit(user_id))
 
     def get_join_quit_log(self, user_id):
         with self._get_connection() as conn:
@@ -269,6 +351,7 @@ class DatabaseManager:
              'reason': reason
              }
         )
+        self._event_bus.publish(UserBanned(user_id, end_date))
 
     def unban(self, user_id: int, reason: str = ''):
         self._execute_simple_set_query(
@@ -277,6 +360,7 @@ class DatabaseManager:
              'reason': reason
              }
         )
+        self._event_bus.publish(UserUnbanned(user_id))
 
     def is_user_banned(self, user_id: int) -> int:
         try:
@@ -293,137 +377,85 @@ class DatabaseManager:
 
 # -------------------------- [CAPTCHA MANAGEMENT] -----------------------------
 
-    def get_user_failed_attempts_from_captcha_status(self,
-                                                     user_id: int) -> int:
-        row = self._execute_get_query_for_1_row(
-            queries.GET_USER_FAILED_ATTEMPTS_FROM_CAPTCHA_STATUS,
-            {'user_id': user_id},
-            f'User id: {user_id} is not present in the captcha status table'
-        )
-        return int(row['failed_attempts'])
-
-    def get_user_total_failed_attempts_from_captcha_status(
-            self,
-            user_id: int) -> int:
-
-        row = self._execute_get_query_for_1_row(
-            queries.GET_USER_TOTAL_FAILED_ATTEMPTS_FROM_CAPTCHA_STATUS,
-            {'user_id': user_id},
-            f'User id: {user_id} is not present in the captcha status table'
-        )
-        return int(row['total_failed_attempts'])
-
-    def get_user_passed_from_captcha_status(self, user_id: int) -> bool:
-
+    def get_captcha_status(self, user_id: int) \
+            -> 'custom_dataclasses.CaptchaStatus':
+        '''
+        @raises ValueError if the user has no captcha status
+        '''
         row = self._execute_get_query_for_1_row(
-            queries.GET_USER_PASSED_FROM_CAPTCHA_STATUS,
+            queries.GET_CAPTCHA_STATUS,
             {'user_id': user_id},
             f'User id: {user_id} is not present in the captcha status table'
         )
-        if row["passed"]:
-            return True
-        else:
-            return False
-
-    def get_user_current_captcha_value(self, user_id: int) -> str:
-        row = self._execute_get_query_for_1_row(
-            queries.GET_USER_CURRENT_CAPTCHA_VALUE,
-            {'user_id': user_id},
-            f'User id: {user_id} is not present in the captchas table'
-        )
-        return str(row["current_value"])
-
-    def get_user_current_captcha_creation_time_date(
-            self,
-            user_id: int) -> datetime:
-        row = self._execute_get_query_for_1_row(
-            queries.GET_USER_CURRENT_CAPTCHA_CREATION_TIME_DATE,
-            {'user_id': user_id},
-            f'User id: {user_id} is not present in the captchas table'
-        )
-        return datetime.utcfromtimestamp(row["unix_creation_time_date"])
-
-    def get_user_current_captcha_last_try_time_date(
+        return custom_dataclasses.CaptchaStatus(
             self,
-            user_id: int) -> datetime:
-
-        row = self._execute_get_query_for_1_row(
-            queries.GET_USER_CURRENT_CAPTCHA_LAST_TRY_TIME_DATE,
-            {'user_id': user_id},
-            f'User id: {user_id} is not present in the captchas table'
+            user_id,
+            failed_attempts=int(row['failed_attempts']),
+            total_failed_attempts=int(row['total_failed_attempts']),
+            passed=bool(row['passed']),
+            creation_time=datetime.utcfromtimestamp(
+                row['unix_creation_time_date']),
+            last_try_time=datetime.utcfromtimestamp(
+                row['unix_last_try_time_date']),
+            current_value=str(row['current_value'])
         )
 
-        return datetime.utcfromtimestamp(row["unix_last_try_time_date"])
-
-    def set_user_failed_attempts_from_captcha_status(self,
-                                                     user_id: int,
-                                                     failed_attempts_no: int):
-        if failed_attempts_no >= 0:
-            self._execute_simple_set_query(
-                queries.SET_USER_FAILED_ATTEMPTS_FROM_CAPTCHA_STATUS,
-                {'user_id': user_id,
-                 'failed_attempts': failed_attempts_no},
-            )
-        else:
-            raise ValueError("failed_attempts_no must be >= 0")
+    def save_captcha_status(self,
+                            captcha_status: 'custom_dataclasses.CaptchaStatus',
+                            passed_changed: bool = False):
+        '''
+        Writes the whole captcha status in a single transaction
+        '''
+        if captcha_status.failed_attempts < 0:
+            raise ValueError("failed_attempts must be >= 0")
+        if captcha_status.total_failed_attempts < 0:
+            raise ValueError("total_failed_attempts must be >= 0")
+
+        param_dict = {
+            'user_id': captcha_status.user_id,
+            'failed_attempts': captcha_status.failed_attempts,
+            'total_failed_attempts': captcha_status.total_failed_attempts,
+            'passed': bool(captcha_status.passed),
+            'current_value': captcha_status.current_value,
+            'unix_creation_time_date': int(
+                captcha_status.creation_time.replace(tzinfo=timezone.utc)
+                .timestamp()),
+            'unix_last_try_time_date': int(
+                captcha_status.last_try_time.replace(tzinfo=timezone.utc)
+                .timestamp())
+        }
+        with self._get_connection() as conn:
+            logger.debug(f'Saving {captcha_status}')
+            conn.execute(queries.SAVE_CAPTCHA_STATUS, param_dict)
+            conn.execute(queries.SAVE_ACTIVE_CAPTCHA, param_dict)
 
-    def set_user_total_failed_attempts_from_captcha_status(
-            self,
-            user_id: int,
-            total_failed_attempts_no: int):
+        if passed_changed:
+            if captcha_status.passed:
+                self._event_bus.publish(CaptchaPassed(captcha_status.user_id))
+            else:
+                self._event_bus.publish(CaptchaReset(captcha_status.user_id))
 
-        if total_failed_attempts_no >= 0:
-            self._execute_simple_set_query(
-                queries.SET_USER_TOTAL_FAILED_ATTEMPTS_FROM_CAPTCHA_STATUS,
-                {'user_id': user_id,
-                 'total_failed_attempts': total_failed_attempts_no},
+    def delete_expired_captchas(self, cutoff_date: datetime,
+                                pending_cutoff_date: datetime,
+                                batch_size: int) -> int:
+        '''
+        Deletes at most batch_size captchas created and last tried before
+        cutoff_date, or before pending_cutoff_date for the captchas still
+        waiting for an answer
+        @returns The number of deleted captchas
+        '''
+        with self._get_connection() as conn:
+            cursor = conn.execute(
+                queries.DELETE_EXPIRED_CAPTCHAS,
+                {'unix_cutoff_date': int(cutoff_date
+                                         .replace(tzinfo=timezone.utc)
+                                         .timestamp()),
+                 'unix_pending_cutoff_date': int(
+                     pending_cutoff_date.replace(tzinfo=timezone.utc)
+                     .timestamp()),
+                 'batch_size': batch_size}
             )
-        else:
-            raise ValueError("total_failed_attempts_no must be >= 0")
-
-    def set_user_passed_from_captcha_status(self, user_id: int, passed: int):
-        self._execute_simple_set_query(
-            queries.SET_USER_PASSED_FROM_CAPTCHA_STATUS,
-            {'user_id': user_id, 'passed': passed == True}
-        )
-
-    def set_user_current_captcha_value(self, user_id: int, value: str):
-        self._execute_simple_set_query(
-            queries.SET_USER_CURRENT_CAPTCHA_VALUE,
-            {'user_id': user_id, 'current_value': value}
-        )
-
-    def set_user_current_captcha_creation_time_date(
-            self,
-            user_id: int,
-            creation_time_date: datetime = None):
-
-        if not creation_time_date:
-            creation_time_date = datetime.utcnow()
-        self._execute_simple_set_query(
-            queries.SET_USER_CURRENT_CAPTCHA_CREATION_TIME_DATE,
-            {'user_id': user_id,
-             'unix_creation_time_date': int(creation_time_date
-                                            .replace(tzinfo=timezone.utc)
-                                            .timestamp())
-             }
-        )
-
-    def set_user_current_captcha_last_try_time_date(
-            self,
-            user_id: int,
-            last_try_time_date: datetime = None):
-
-        if not last_try_time_date:
-            last_try_time_date = datetime.utcnow()
-        self._execute_simple_set_query(
-            queries.SET_USER_CURRENT_CAPTCHA_LAST_TRY_TIME_DATE,
-            {'user_id': user_id,
-             'unix_last_try_time_date': int(last_try_time_date
-                                            .replace(tzinfo=timezone.utc)
-                                            .timestamp())
-             }
-        )
+            return cursor.rowcount
 
 # ------------------------------ [PERMISSIONS] --------------------------------
 
@@ -436,6 +468,7 @@ class DatabaseManager:
             {'user_id': user_id,
              'permissions': int(permissions)}
         )
+        self._event_bus.publish(PermissionsChanged(user_id, permissions))
         logger.debug(f'Set user {user_id} permissions to {permissions}')
 
     def get_user_permissions(self, user_id: int) -> Permissions:
@@ -448,6 +481,26 @@ class DatabaseManager:
 
 # -------------------------------- [ROLES] ------------------------------------
 
+    def _rebuild_role_table(self):
+        '''
+        Replaces the roles snapshot, must be called after every role edit
+        '''
+        self._role_table = RoleTable(
+            self._execute_simple_get_query(queries.GET_ROLES_TABLE))
+
+    def _on_role_edited(self, event: RoleEdited):
+        self._rebuild_role_table()
+        if event.role_name in self._role_table:
+            power = self._role_table[event.role_name].power
+            for row in self._execute_simple_get_query(
+                    queries.GET_USERS_BY_ROLE,
+                    {'role_name': event.role_name}):
+                self._user_state_store.set_role_power(row['user_id'], power)
+
+    @property
+    def role_table(self) -> RoleTable:
+        return self._role_table
+
     def create_role(self,
                     role_name,
                     power: int = 0,
@@ -460,6 +513,7 @@ class DatabaseManager:
                  'role_permissions': int(permissions)
                  }
         )
+        self._event_bus.publish(RoleEdited(role_name))
 
     def delete_role(self, role_name):
         if role_name != 'default':
@@ -470,6 +524,7 @@ class DatabaseManager:
                     queries.DELETE_ROLE,
                     {'role_name': role_name}
             )
+            self._event_bus.publish(RoleEdited(role_name))
         else:
             raise ValueError('Cannot delete the default role')
 
@@ -479,6 +534,18 @@ class DatabaseManager:
                 {'user_id': user_id,
                  'role_name': role_name},
             )
+        # The permissions are set by the user_role_change triggers
+        self._event_bus.publish(RoleChanged(user_id, role_name))
+
+    def get_user_role_power(self, user_id: int) -> int:
+        '''
+        @returns The power of the user's role, 0 if the user has no role
+        '''
+        try:
+            return self._user_state_store.get_role_power(user_id)
+        except KeyError:
+            role = self.get_user_role(user_id)
+            return role.power if role else 0
 
     def get_user_role(self, user_id: int):
         try:
@@ -511,6 +578,7 @@ class DatabaseManager:
             {'role_name': role_name,
              'role_permissions': int(new_permissions)}
         )
+        self._event_bus.publish(RoleEdited(role_name))
 
     def set_role_power(self, role_name: str, new_power: int):
         self._execute_simple_set_query(
@@ -518,44 +586,29 @@ class DatabaseManager:
             {'role_name': role_name,
              'role_power': new_power}
         )
+        self._event_bus.publish(RoleEdited(role_name))
 
     def get_role_permissions(self, role_name: str) -> Permissions:
-        row = self._execute_get_query_for_1_row(
-            queries.GET_ROLE_PERMISSIONS,
-            {'role_name': role_name}
-        )
-        return Permissions(row['role_permissions'])
+        try:
+            return self._role_table[role_name].permissions
+        except KeyError:
+            raise ValueError(f'Role {role_name} does not exist')
 
     def get_role_power(self, role_name: str) -> int:
-        row = self._execute_get_query_for_1_row(
-            queries.GET_ROLE_POWER,
-            {'role_name': role_name}
-        )
-        return int(row['role_power'])
+        try:
+            return self._role_table[role_name].power
+        except KeyError:
+            raise ValueError(f'Role {role_name} does not exist')
 
     def get_roles(self):
-        return map(lambda x: custom_dataclasses.Role(self, x['role_name']),
-                   self._execute_simple_get_query(queries.GET_ROLES))
+        return map(lambda x: custom_dataclasses.Role(self, x.name),
+                   self._role_table)
 
     def does_role_exist(self, role_name: str):
-        try:
-            row = self._execute_get_query_for_1_row(
-                queries.DOES_ROLE_EXIST,
-                {'role_name': role_name}
-            )
-            if row[0]:
-                return True
-            else:
-                return False
-        except ValueError:
-            return False
+        return role_name in self._role_table
 
     def show_roles(self):
-        cursor = self._execute_simple_get_query(
-            queries.GET_ROLES,
-        )
-        return map(lambda x: custom_dataclasses.Role(
-            self, x['role_name']), cursor)
+        return self.get_roles()
 
 
 # ------------------------------- [ANTIFLOOD] ---------------------------------
@@ -567,18 +620,34 @@ class DatabaseManager:
             )
         return timedelta(milliseconds=int(row['chat_delay']))
 
+    def get_users_chat_delays(self, user_ids: Iterable[int]) -> dict:
+        '''
+        @returns user_id -> chat delay of the users that have got one, read
+        with a single query
+        '''
+        cursor = self._execute_simple_get_query(
+            queries.GET_USERS_CHAT_DELAYS,
+            {'user_ids': json.dumps(list(user_ids))}
+        )
+        return {
+            row['user_id']: timedelta(milliseconds=int(row['chat_delay']))
+            for row in cursor
+        }
+
     def set_user_chat_delay(self, user_id: int, delay: timedelta):
         self._execute_simple_set_query(
                 queries.SET_USER_CHAT_DELAY,
                 {'user_id': user_id,
-                 'delay': delay}
+                 'chat_delay': delay // timedelta(milliseconds=1)}
             )
+        self._event_bus.publish(ChatDelayChanged(user_id))
 
     def reset_user_chat_delay(self, user_id: int):
         self._execute_simple_set_query(
                 queries.RESET_USER_CHAT_DELAY,
                 {'user_id': user_id}
             )
+        self._event_bus.publish(ChatDelayChanged(user_id))
 
 # -------------------------------- [PURGE] -----------------------------------
 
@@ -642,6 +711,132 @@ class DatabaseManager:
             )
             logger.debug(f"Query executed")
 
+# ----------------------------- [USER RESOLVER] -------------------------------
+
+    def get_cached_user_info(self, lookup_key: str, max_age: timedelta,
+                             negative_max_age: timedelta):
+        '''
+        @returns The cached user info dict, whose id is None if the lookup
+        key is known to be invalid, and the date of its resolution
+        @raises ValueError if there's no entry younger than max_age (or
+        negative_max_age for invalid keys)
+        '''
+        now = datetime.utcnow()
+        row = self._execute_get_query_for_1_row(
+            queries.GET_CACHED_USER_INFO,
+            {'lookup_key': lookup_key,
+             'unix_min_resolution_date': int((now - max_age)
+                                             .replace(tzinfo=timezone.utc)
+                                             .timestamp()),
+             'unix_negative_min_resolution_date': int(
+                 (now - negative_max_age).replace(tzinfo=timezone.utc)
+                 .timestamp())},
+            f'{lookup_key} is not cached'
+        )
+        return {
+            'first_name': row['first_name'],
+            'last_name': row['last_name'],
+            'username': row['username'],
+            'id': row['user_id']
+        }, datetime.utcfromtimestamp(row['unix_resolution_date'])
+
+    def cache_user_info(self, lookup_keys: Iterable[str],
+                        user_info: dict = None):
+        '''
+        Caches the user info under all the lookup keys, a None user_info
+        marks the keys as invalid
+        '''
+        if not user_info:
+            user_info = {'first_name': None, 'last_name': None,
+                         'username': None, 'id': None}
+        unix_resolution_date = int(datetime.utcnow()
+                                   .replace(tzinfo=timezone.utc).timestamp())
+        with self._get_connection() as conn:
+            logger.debug(f"Executing many queries {queries.CACHE_USER_INFO}")
+            conn.executemany(
+                queries.CACHE_USER_INFO,
+                map(
+                    lambda x: {
+                        'lookup_key': x,
+                        'user_id': user_info['id'],
+                        'username': user_info['username'],
+                        'first_name': user_info['first_name'],
+                        'last_name': user_info['last_name'],
+                        'unix_resolution_date': unix_resolution_date
+                    },
+                    lookup_keys
+                )
+            )
+            logger.debug(f"Query executed")
+
+# ---------------------------- [OBSERVED USERS] -------------------------------
+
+    def register_observed_users(self, observed_users: Iterable[dict]):
+        with self._get_connection() as conn:
+            logger.debug("Executing many queries "
+                         f"{queries.REGISTER_OBSERVED_USER}")
+            conn.executemany(
+                queries.REGISTER_OBSERVED_USER,
+                map(
+                    lambda x: {
+                        'user_id': x['id'],
+                        'username': x['username'],
+                        'first_name': x['first_name'],
+                        'last_name': x['last_name'],
+                        'unix_last_seen_date':
+                        int(x['last_seen_date']
+                            .replace(tzinfo=timezone.utc).timestamp())
+                    },
+                    observed_users
+                )
+            )
+            logger.debug(f"Query executed")
+
+    @staticmethod
+    def _observed_user_row_to_dict(row) -> dict:
+        return {
+            'first_name': row['first_name'],
+            'last_name': row['last_name'],
+            'username': row['username'],
+            'id': row['user_id']
+        }
+
+    def get_observed_user_by_username(self, username: str) -> dict:
+        row = self._execute_get_query_for_1_row(
+            queries.GET_OBSERVED_USER_BY_USERNAME,
+            {'username': username},
+            f'{username} has never been observed'
+        )
+        return self._observed_user_row_to_dict(row)
+
+    def get_observed_user_by_id(self, user_id: int) -> dict:
+        row = self._execute_get_query_for_1_row(
+            queries.GET_OBSERVED_USER_BY_ID,
+            {'user_id': user_id},
+            f'{user_id} has never been observed'
+        )
+        return self._observed_user_row_to_dict(row)
+
+# ----------------------------- [DATABASE INFO] -------------------------------
+
+    def get_last_update_id(self) -> int:
+        '''
+        @returns The id of the last update processed before the bot stopped
+        @raises ValueError if no update has ever been processed
+        '''
+        row = self._execute_get_query_for_1_row(
+            queries.GET_DATABASE_INFO,
+            {'key': 'last_update_id'},
+            'No update has ever been processed'
+        )
+        return int(row['value'])
+
+    def set_last_update_id(self, update_id: int):
+        self._execute_simple_set_query(
+            queries.SET_DATABASE_INFO,
+            {'key': 'last_update_id', 'value': str(update_id)}
+        )
+
 # --------------------------- [ADMINISTRATIVE POLLS] --------------------------
 
     def delete_admin_poll(self, poll_id: int):
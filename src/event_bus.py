@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+#
+# anon_chat_bot is a telegram bot whose main function is to manage an
+# anonymous chat lounge
+# Copyright (C) <2020>  <jacotsu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import queue
+import threading
+from collections import defaultdict, Counter
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable
+from permissions import Permissions
+
+
+logger = logging.getLogger(__name__)
+
+
+# ------------------------------- [EVENTS] ------------------------------------
+
+@dataclass(frozen=True)
+class Event:
+    pass
+
+
+@dataclass(frozen=True)
+class UserEvent(Event):
+    user_id: int
+
+
+@dataclass(frozen=True)
+class UserCreated(UserEvent):
+    pass
+
+
+@dataclass(frozen=True)
+class UserJoined(UserEvent):
+    pass
+
+
+@dataclass(frozen=True)
+class UserQuit(UserEvent):
+    pass
+
+
+@dataclass(frozen=True)
+class UserBanned(UserEvent):
+    end_date: datetime
+
+
+@dataclass(frozen=True)
+class UserUnbanned(UserEvent):
+    pass
+
+
+@dataclass(frozen=True)
+class PermissionsChanged(UserEvent):
+    permissions: Permissions
+
+
+@dataclass(frozen=True)
+class RoleChanged(UserEvent):
+    role_name: str
+
+
+@dataclass(frozen=True)
+class CaptchaPassed(UserEvent):
+    pass
+
+
+@dataclass(frozen=True)
+class CaptchaReset(UserEvent):
+    pass
+
+
+@dataclass(frozen=True)
+class ChatDelayChanged(UserEvent):
+    pass
+
+
+@dataclass(frozen=True)
+class RoleEdited(Event):
+    '''
+    A role has been created, modified or deleted
+    '''
+    role_name: str
+
+
+@dataclass(frozen=True)
+class StaleStateSweep(Event):
+    '''
+    Published periodically by the GarbageCollector, the subscribers evict
+    their stale in memory entries and add how many they evicted to reclaimed
+    '''
+    reclaimed: Counter
+
+
+@dataclass(frozen=True)
+class StormStarted(Event):
+    '''
+    The rate of updates from unverified users is above the storm threshold,
+    the subscribers should save their resources until the storm ends
+    '''
+    rate: float
+
+
+@dataclass(frozen=True)
+class StormEnded(Event):
+    '''
+    The subscribers add how many updates they shed during the storm to shed
+    '''
+    shed: Counter
+
+
+# ------------------------------- [EVENT BUS] ---------------------------------
+
+class EventBus:
+    '''
+    A lightweight publish/subscribe bus for the internal domain events.
+    Synchronous subscribers are called by the publishing thread, queued
+    subscribers are called in order by a dedicated delivery thread, so slow
+    subscribers don't delay the publisher. Subscribing to an event class
+    subscribes to all its subclasses too
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(list)
+        self._queue = queue.Queue()
+        self._delivery_thread = None
+
+    def subscribe(self, event_type: type, callback: Callable,
+                  queued: bool = False):
+        with self._lock:
+            self._subscribers[event_type].append((callback, queued))
+            if queued and not self._delivery_thread:
+                self._delivery_thread = threading.Thread(
+                    target=self._deliver_queued_events,
+                    name='event_bus',
+                    daemon=True
+                )
+                self._delivery_thread.start()
+        logger.debug(f'{callback} subscribed to {event_type.__name__}')
+
+    def unsubscribe(self, event_type: type, callback: Callable):
+        with self._lock:
+            self._subscribers[event_type] = [
+                x for x in self._subscribers[event_type] if x[0] != callback
+            ]
+
+    def publish(self, event: Event):
+        logger.debug(f'Publishing {event}')
+        with self._lock:
+            subscribers = [
+                subscriber
+                for event_type in type(event).__mro__
+                for subscriber in self._subscribers.get(event_type, ())
+            ]
+
+        for callback, queued in subscribers:
+            if queued:
+                self._queue.put((callback, event))
+            else:
+                self._call(callback, event)
+
+    @staticmethod
+    def _call(callback, event):
+        # A broken subscriber must not break the publisher nor the other
+        # subscribers
+        try:
+            callback(event)
+        except Exception:
+            logger.exception(f'{callback} failed to handle {event}')
+
+    def _deliver_queued_events(self):
+        while True:
+            callback, event = self._queue.get()
+            self._call(callback, event)
+            self._queue.task_done()
+
+    def join(self):
+        '''
+        Blocks until all the queued events have been delivered
+        '''
+        self._queue.join()
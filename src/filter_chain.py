@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+#
+# anon_chat_bot is a telegram bot whose main function is to manage an
+# anonymous chat lounge
+# Copyright (C) <2020>  <jacotsu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import threading
+from dataclasses import dataclass
+from time import perf_counter_ns
+from telegram.ext.filters import BaseFilter
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class FilterStats:
+    filter: BaseFilter
+    calls: int = 0
+    rejections: int = 0
+    cost_ns: int = 0
+
+    @property
+    def cost_per_rejection(self) -> float:
+        '''
+        The mean cost divided by the rejection rate, the smaller the earlier
+        the filter should run. Both are smoothed, so unused filters stay in the
+        middle
+        '''
+        mean_cost = (self.cost_ns + 1) / (self.calls + 1)
+        rejection_rate = (self.rejections + 1) / (self.calls + 2)
+        return mean_cost / rejection_rate
+
+
+class FilterChain(BaseFilter):
+    '''
+    The conjunction of a sequence of stages. A stage is either a filter or a
+    list of filters that don't depend on each other.
+    The stages always run in the given order, so they express the ordering
+    constraints of the chain, while the filters of a stage are reordered every
+    reorder_interval evaluations by increasing cost per rejection, measured
+    at runtime, so that the cheapest rejections happen first.
+    Reordering changes which filters run, so the filters of a list stage must
+    have no side effects. Once a stage rejects an update, the notify_rejection
+    method of the first filter rejecting it in the given order, if defined,
+    sends the notices (see MessageBrokeredFilter), so the users get the same
+    notices whatever the order
+    '''
+    update_filter = True
+
+    def __init__(self, *stages, reorder_interval: int = 1000):
+        self._given_stages = [
+            list(stage) if isinstance(stage, (list, tuple)) else [stage]
+            for stage in stages
+        ]
+        self._stages = [[FilterStats(x) for x in stage]
+                        for stage in self._given_stages]
+        self._reorder_interval = reorder_interval
+        self._evaluations = 0
+        # The lanes evaluate the chain concurrently
+        self._lock = threading.Lock()
+        self.name = ' & '.join(repr(x.filter) for x in self.stats)
+
+    def filter(self, update):
+        with self._lock:
+            self._evaluations += 1
+            if self._evaluations % self._reorder_interval == 0:
+                self._reorder()
+            stages = self._stages
+
+        for index, stage in enumerate(stages):
+            if len(stage) == 1:
+                # Nothing to reorder, nothing to measure
+                if not stage[0].filter(update):
+                    self._notify_rejection(stage[0].filter, update)
+                    return False
+                continue
+
+            for stats in stage:
+                start_time = perf_counter_ns()
+                result = stats.filter(update)
+                cost_ns = perf_counter_ns() - start_time
+                with self._lock:
+                    stats.cost_ns += cost_ns
+                    stats.calls += 1
+                    if not result:
+                        stats.rejections += 1
+                if not result:
+                    # The filters have no side effects, the ones before it
+                    # in the given order can run again
+                    self._notify_rejection(
+                        next(x for x in self._given_stages[index]
+                             if x is stats.filter or not x(update)),
+                        update)
+                    return False
+        return True
+
+    @staticmethod
+    def _notify_rejection(rejecting_filter: BaseFilter, update):
+        notify_rejection = getattr(rejecting_filter, 'notify_rejection', None)
+        if notify_rejection:
+            notify_rejection(update if rejecting_filter.update_filter
+                             else update.effective_message)
+
+    @property
+    def stats(self) -> list:
+        '''
+        @returns The stats of the filters in their current order
+        '''
+        return [stats for stage in self._stages for stats in stage]
+
+    def _reorder(self):
+        stages = []
+        for stage in self._stages:
+            stage = sorted(stage, key=lambda x: x.cost_per_rejection)
+            # Halving the counters makes the old traffic count less and less
+            for stats in stage:
+                stats.calls //= 2
+                stats.rejections //= 2
+                stats.cost_ns //= 2
+            stages.append(stage)
+        # Swapped at once, the filters are never seen partially reordered
+        self._stages = stages
+        logger.debug(f'Reordered the filter chain: {self.stats}')
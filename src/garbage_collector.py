@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+#
+# anon_chat_bot is a telegram bot whose main function is to manage an
+# anonymous chat lounge
+# Copyright (C) <2020>  <jacotsu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import logging
+from collections import Counter
+from datetime import datetime, timedelta
+from pytimeparse.timeparse import timeparse
+from event_bus import StaleStateSweep
+
+
+logger = logging.getLogger(__name__)
+
+
+class GarbageCollector:
+    '''
+    Deletes the expired captchas from the database and asks the other
+    components, through a StaleStateSweep event, to evict their stale in
+    memory entries. Meant to be run periodically
+    '''
+    def __init__(self, database_manager, config):
+        self._db_man = database_manager
+        gc_config = config.get("GarbageCollection", {})
+        # A solved or reset captcha can be deleted once its last attempt can
+        # no longer delay the next one
+        self._captcha_retention = timedelta(seconds=timeparse(
+            config["Captcha"]["TimeDelayBetweenAttempts"]))
+        # A slow but right answer to a pending captcha must still be checked
+        self._pending_captcha_retention = timedelta(seconds=timeparse(
+            gc_config.get("PendingCaptchaRetention", "1d")))
+        self.interval = timeparse(gc_config.get("Interval", "10m"))
+        self._batch_size = int(gc_config.get("BatchSize", 500))
+
+    def collect(self) -> Counter:
+        '''
+        @returns The number of reclaimed rows and entries by kind
+        '''
+        reclaimed = Counter()
+        now = datetime.utcnow()
+        cutoff_date = now - self._captcha_retention
+        pending_cutoff_date = now - self._pending_captcha_retention
+        while True:
+            deleted = self._db_man.delete_expired_captchas(
+                cutoff_date, pending_cutoff_date, self._batch_size)
+            reclaimed['expired_captchas'] += deleted
+            if deleted < self._batch_size:
+                break
+
+        self._db_man.event_bus.publish(StaleStateSweep(reclaimed))
+        logger.info('Garbage collection reclaimed ' + (', '.join(
+            f'{number} {kind}' for kind, number in reclaimed.items())
+            or 'nothing'))
+        return reclaimed
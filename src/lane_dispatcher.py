@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+#
+# anon_chat_bot is a telegram bot whose main function is to manage an
+# anonymous chat lounge
+# Copyright (C) <2020>  <jacotsu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import threading
+from collections import deque
+from enum import IntEnum
+from queue import Empty
+from time import monotonic
+from typing import Callable
+from telegram import Update
+from telegram.ext import Dispatcher
+
+
+logger = logging.getLogger(__name__)
+
+
+class _LaneEntry:
+    __slots__ = ('time', 'key', 'priority', 'item', 'served')
+
+    def __init__(self, key, priority: int, item):
+        self.time = monotonic()
+        self.key = key
+        self.priority = priority
+        self.item = item
+        # Served ahead of its class, removed once it reaches the head
+        self.served = False
+
+
+class _LaneTask:
+    __slots__ = ('callback', 'args', 'kwargs')
+
+    def __init__(self, callback: Callable, args, kwargs):
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+
+    def run(self):
+        try:
+            self.callback(*self.args, **self.kwargs)
+        except Exception:
+            logger.exception(f'Lane task {self.callback} failed')
+
+
+class PriorityLane:
+    '''
+    A FIFO queue for each priority class, the lowest class is served first.
+    An item that has waited more than max_wait seconds is served before the
+    items of the higher classes, so the lower classes can't starve.
+    The items with the same key are always served in order: when an item is
+    picked while an earlier item with its key is still queued, the earlier
+    one is served instead
+    '''
+    def __init__(self, classes: int, max_wait: float):
+        self._queues = [deque() for _ in range(classes)]
+        self._depths = [0] * classes
+        # key -> entries in arrival order
+        self._keys = {}
+        self._max_wait = max_wait
+        self._condition = threading.Condition()
+        self._closed = False
+
+    @property
+    def depths(self) -> list:
+        return list(self._depths)
+
+    def put(self, item, priority: int, key=None):
+        '''
+        The items without a key aren't ordered with the other ones
+        '''
+        entry = _LaneEntry(key, priority, item)
+        with self._condition:
+            self._queues[priority].append(entry)
+            self._depths[priority] += 1
+            if key is not None:
+                self._keys.setdefault(key, deque()).append(entry)
+            self._condition.notify()
+
+    def close(self):
+        '''
+        get returns None once the lane is closed and empty
+        '''
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def get(self):
+        with self._condition:
+            while not any(self._depths):
+                if self._closed:
+                    return None
+                self._condition.wait()
+
+            for queue in self._queues:
+                while queue and queue[0].served:
+                    queue.popleft()
+
+            now = monotonic()
+            starving_queues = [x for x in self._queues
+                               if x and now - x[0].time > self._max_wait]
+            if starving_queues:
+                queue = min(starving_queues, key=lambda x: x[0].time)
+            else:
+                queue = next(x for x in self._queues if x)
+
+            entry = queue[0]
+            if entry.key is not None:
+                key_entries = self._keys[entry.key]
+                entry = key_entries.popleft()
+                if not key_entries:
+                    del self._keys[entry.key]
+
+            queue = self._queues[entry.priority]
+            if queue[0] is entry:
+                queue.popleft()
+            else:
+                entry.served = True
+            self._depths[entry.priority] -= 1
+            return entry.item
+
+
+class LaneDispatcher(Dispatcher):
+    '''
+    A dispatcher that spreads the updates over lanes by user id and
+    processes the lanes concurrently. The updates of a user always go to the
+    same lane, so they are processed one at a time, while the updates of
+    different users are processed in parallel.
+    classify maps each update to one of the priorities, within a lane the
+    higher priorities are served first (see PriorityLane), but the updates
+    of a user are always served in order.
+    The updates waiting in the update queue are taken in batches of up to
+    batch_size, and prefetch is called with each batch before the batch is
+    spread over the lanes. The updates for which admit returns False are
+    dropped before the prefetch.
+    run_in_lane runs some work about a user in the user's lane, in order with
+    the user's updates
+    '''
+    def __init__(self, *args, lanes: int = 4, batch_size: int = 100,
+                 prefetch: Callable = None, priorities: IntEnum = None,
+                 classify: Callable = None, max_priority_wait: float = 5,
+                 admit: Callable = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._priorities = list(priorities) if priorities else [0]
+        self._classify = classify
+        self._lanes = [PriorityLane(len(self._priorities), max_priority_wait)
+                       for _ in range(max(lanes, 1))]
+        self._lane_threads = []
+        self._batch_size = batch_size
+        self._prefetch = prefetch
+        self._admit = admit
+        # The ids of the updates queued in the lanes and not processed yet
+        self._in_flight = set()
+        self._highest_update_id = 0
+        self._in_flight_lock = threading.Lock()
+
+    @property
+    def lane_depths(self) -> list:
+        '''
+        @returns The number of updates waiting in each lane
+        '''
+        return [sum(lane.depths) for lane in self._lanes]
+
+    @property
+    def last_update_id(self) -> int:
+        '''
+        @returns The highest id up to which every update has been processed
+        or dropped, 0 if none
+        '''
+        with self._in_flight_lock:
+            if self._in_flight:
+                return min(self._in_flight) - 1
+            return self._highest_update_id
+
+    @property
+    def priority_depths(self) -> dict:
+        '''
+        @returns priority -> number of updates of that priority waiting in
+        all the lanes
+        '''
+        depths = [sum(x) for x in zip(*(lane.depths for lane in self._lanes))]
+        return dict(zip(self._priorities, depths))
+
+    def start(self, ready=None):
+        if not self._lane_threads:
+            for number, lane in enumerate(self._lanes):
+                thread = threading.Thread(target=self._process_lane,
+                                          args=(lane,),
+                                          name=f'lane_{number}',
+                                          daemon=True)
+                thread.start()
+                self._lane_threads.append(thread)
+            logger.debug(f'Started {len(self._lanes)} lanes')
+        super().start(ready)
+
+    def stop(self):
+        # No update is added to the lanes once the dispatcher has stopped
+        super().stop()
+        for lane in self._lanes:
+            lane.close()
+        for thread in self._lane_threads:
+            thread.join()
+        self._lane_threads = []
+
+    def process_update(self, update):
+        # The updater queues all the updates of a getUpdates call at once
+        updates = [update]
+        while len(updates) < self._batch_size:
+            try:
+                updates.append(self.update_queue.get_nowait())
+            except Empty:
+                break
+            self.update_queue.task_done()
+
+        update_ids = [x.update_id for x in updates if isinstance(x, Update)]
+        if self._admit:
+            updates = [x for x in updates if self._is_admitted(x)]
+
+        with self._in_flight_lock:
+            self._in_flight.update(
+                x.update_id for x in updates if isinstance(x, Update))
+            self._highest_update_id = max([self._highest_update_id] +
+                                          update_ids)
+        if not updates:
+            return
+
+        if self._prefetch:
+            try:
+                self._prefetch(updates)
+            except Exception:
+                # The updates can still be processed without
+                logger.exception(f'Prefetch failed for {len(updates)} '
+                                 'updates')
+
+        for update in updates:
+            self._lanes[self._lane_index(update)].put(
+                update, self._priority_index(update), self._user_id(update))
+
+    def run_in_lane(self, user_id: int, callback: Callable, *args,
+                    priority=None, **kwargs):
+        '''
+        Queues a call to callback in the lane of the user, after the updates
+        of the user queued so far. The lowest priority is used if none is
+        given
+        '''
+        priority_index = len(self._priorities) - 1 if priority is None \
+            else self._priorities.index(priority)
+        self._lanes[user_id % len(self._lanes)].put(
+            _LaneTask(callback, args, kwargs), priority_index, user_id)
+
+    def _is_admitted(self, update) -> bool:
+        try:
+            return self._admit(update)
+        except Exception:
+            logger.exception(f'Cannot admit {update}')
+            return True
+
+    def _priority_index(self, update) -> int:
+        if not self._classify:
+            return 0
+        try:
+            return self._priorities.index(self._classify(update))
+        except Exception:
+            logger.exception(f'Cannot classify {update}')
+            return len(self._priorities) - 1
+
+    @staticmethod
+    def _user_id(update) -> int:
+        if isinstance(update, Update) and update.effective_user:
+            return update.effective_user.id
+        return None
+
+    def _lane_index(self, update) -> int:
+        user_id = self._user_id(update)
+        if user_id is not None:
+            return user_id % len(self._lanes)
+        if isinstance(update, Update):
+            return update.update_id % len(self._lanes)
+        # Errors and other kinds of updates aren't tied to a user
+        return 0
+
+    def _process_lane(self, lane: PriorityLane):
+        while True:
+            update = lane.get()
+            if update is None:
+                break
+            if isinstance(update, _LaneTask):
+                update.run()
+                continue
+            super().process_update(update)
+            if isinstance(update, Update):
+                with self._in_flight_lock:
+                    self._in_flight.discard(update.update_id)
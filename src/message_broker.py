@@ -21,7 +21,8 @@
 
 from typing import Iterable
 import logging
-from telegram.ext import MessageHandler, Filters, messagequeue
+import threading
+from telegram.ext import MessageHandler, CallbackQueryHandler, Filters
 from telegram import Message, Audio, Contact, Document, Animation,\
         Location, PhotoSize, Sticker, Venue, Video, VideoNote, Voice,\
         InputMediaPhoto, ParseMode
@@ -31,6 +32,11 @@ from permissions import Permissions
 from poll_types import PollTypes
 from custom_dataclasses import User
 from custom_logging import user_log_str
+from custom_exceptions import MaxCaptchaTriesError, CaptchaFloodError, \
+    StaleCaptchaError, CaptchaExpiredError
+from misc import user_join
+from filter_chain import FilterChain
+from utils import LRUCache
 
 logger = logging.getLogger(__name__)
 
@@ -39,11 +45,17 @@ class MessageBroker:
     '''
     This class' main purpose is to send messages to valid users
     '''
-    def __init__(self, updater, database_manager, captcha_manager, config):
+    def __init__(self, updater, database_manager, captcha_manager, config,
+                 send_scheduler):
         self._db_man = database_manager
         self._updater = updater
         self._captcha_manager = captcha_manager
-        self._poll_pool = {}
+        self._config = config
+        # poll id -> chat and message id of the first copy of the poll, the
+        # other recipients get it forwarded. The senders create the copies
+        # concurrently, so the first one is created under a lock
+        self._poll_pool = LRUCache(1024, 3600)
+        self._poll_lock = threading.Lock()
         self._message_forward_map = {
             Audio: lambda x, y:  self._updater.bot.send_audio(
                 x.id, y.audio.file_id, y.caption),
@@ -75,56 +87,105 @@ class MessageBroker:
                 x.id, y)
         }
 
-        self._is_messages_queued_default = True
         # Important to avoid hitting telegram's anti flood limits
-        self._msg_queue = messagequeue.MessageQueue(
-            all_burst_limit=29,
-            all_time_limit_ms=1017)
+        self._send_scheduler = send_scheduler
 
         self._updater.dispatcher.add_handler(
             # NB: The captcha filter must come before the permissions filter
             # otherwhise new users won't be able to pass the verification
             MessageHandler(
-                UnbannedUsersFilter(self._db_man, self) &
-                ~Filters.command &
-                PassedCaptchaFilter(
-                    self._db_man,
-                    self._captcha_manager,
-                    config,
-                    self
-                ) &
-                AntiFloodFilter(self._db_man, config, self) &
-                MessagePermissionsFilter(self._db_man, self),
+                FilterChain(
+                    [
+                        ~Filters.command,
+                        UnbannedUsersFilter(self._db_man, self),
+                        PassedCaptchaFilter(
+                            self._db_man,
+                            self._captcha_manager,
+                            config,
+                            self
+                        )
+                    ],
+                    AntiFloodFilter(self._db_man, config, self),
+                    MessagePermissionsFilter(self._db_man, self)
+                ),
                 callback=self._message_callback))
 
+        # Captcha challenges answered through inline keyboards
+        captcha_callback_pattern = captcha_manager.strategy.callback_pattern
+        if captcha_callback_pattern:
+            self._updater.dispatcher.add_handler(
+                CallbackQueryHandler(self._captcha_callback,
+                                     pattern=captcha_callback_pattern))
+
+    def _captcha_callback(self, update, context):
+        query = update.callback_query
+        user = User(self._db_man, query.from_user)
+        if user.captcha_status.passed or user.is_banned:
+            query.answer()
+            return
+
+        try:
+            self._captcha_manager.submit_captcha(user, query.data)
+        except MaxCaptchaTriesError as e:
+            query.answer(e.reason)
+            return
+        except CaptchaFloodError:
+            query.answer(f'You can try once every '
+                         f'{self._captcha_manager.delay}')
+            return
+        except StaleCaptchaError:
+            query.answer('This captcha is no longer valid')
+            query.edit_message_reply_markup()
+            return
+        except CaptchaExpiredError:
+            # Not counted as a failure, a new keyboard replaces the old one
+            query.answer('Captcha expired, here is a new one')
+            query.edit_message_reply_markup()
+            self._captcha_manager.start_captcha_session(user, query.message)
+            return
+
+        if user.captcha_status.passed:
+            logger.info(f'{user} has passed the captcha challenge')
+            query.answer('Captcha passed')
+            query.edit_message_reply_markup()
+            user_join(user, self._config, self)
+        else:
+            logger.info(f'{user} has failed the captcha challenge '
+                        f'({user.captcha_status.failed_attempts}/'
+                        f'{self._captcha_manager.max_tries})')
+            query.answer('Wrong captcha')
+            self._captcha_manager.start_captcha_session(user, query.message)
+
     def _send_photo(self, user_id, message):
         message.photo.sort(reverse=True, key=lambda x: x.width)
         self._updater.bot.send_photo(user_id, message.photo[0])
 
     def _process_special_message(self, user_id, message):
         if message.poll:
-            if message.poll.id in self._poll_pool:
-                sent_msg = self._updater.bot.forward_message(
-                    user_id,
-                    self._poll_pool[message.poll.id]['sender_id'],
-                    message_id=self._poll_pool[message.poll.id]
-                    ['message_id']
-                )
-            else:
-                sent_msg = self._updater.bot.send_poll(
-                    user_id,
-                    message.poll.question,
-                    [option.text for option in message.poll.options],
-                    True,
-                    allow_multiple_answers=message.poll.
-                    allows_multiple_answers,
-                    open_period=message.poll.open_period
-                )
-                self._poll_pool[message.poll.id] = {
-                    'sender_id': user_id,
-                    'message_id': sent_msg.message_id
-                }
-                message.delete()
+            with self._poll_lock:
+                try:
+                    poll_copy = self._poll_pool.get(message.poll.id)
+                except KeyError:
+                    sent_msg = self._updater.bot.send_poll(
+                        user_id,
+                        message.poll.question,
+                        [option.text for option in message.poll.options],
+                        True,
+                        allow_multiple_answers=message.poll.
+                        allows_multiple_answers,
+                        open_period=message.poll.open_period
+                    )
+                    self._poll_pool.put(message.poll.id, {
+                        'sender_id': user_id,
+                        'message_id': sent_msg.message_id
+                    })
+                    message.delete()
+                    return sent_msg
+            sent_msg = self._updater.bot.forward_message(
+                user_id,
+                poll_copy['sender_id'],
+                message_id=poll_copy['message_id']
+            )
         elif message.text:
             sent_msg = self._updater.bot.send_message(
                 user_id,
@@ -176,8 +237,7 @@ class MessageBroker:
                           permissions: Permissions = Permissions.RECEIVE):
         # Select only users whose permissions match
         # Banned and inactive users are automatically filtered by the database
-        effective_users = filter(lambda x: permissions in x.permissions,
-                                 self._db_man.get_active_users())
+        effective_users = self._db_man.get_active_users(permissions)
 
         if isinstance(message, Message) and \
                 type(message.effective_attachment) not in \
@@ -188,16 +248,16 @@ class MessageBroker:
             for user in effective_users:
                 self.send_or_forward_msg(user, message)
 
-            # Trying to free some memory
-            self._poll_pool = {}
-
-    @messagequeue.queuedmessage
     def send_or_forward_msg(self, user, message,
                             parse_mode=ParseMode.MARKDOWN_V2):
         '''
-        Sends the anonymized message to the specified user. If the user has the
-        VIEW_CLEAR_MSGS permission the message is forwarded
+        Queues the anonymized message for the specified user. If the user has
+        the VIEW_CLEAR_MSGS permission the message is forwarded
         '''
+        self._send_scheduler.submit(user.id, self._send_or_forward_msg,
+                                    user, message, parse_mode)
+
+    def _send_or_forward_msg(self, user, message, parse_mode):
         logger.debug(f'Relaying message to {user}')
         if isinstance(message, Message):
             if Permissions.VIEW_CLEAR_MSGS in user.permissions:
@@ -214,7 +274,7 @@ class MessageBroker:
                     )
 
             # Batch registering is more efficient but harder to implement due
-            # to the delayed message queue
+            # to the delayed send scheduler
             self._db_man.register_messages([
                 {
                     'sender_id': message.from_user.id,
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+#
+# anon_chat_bot is a telegram bot whose main function is to manage an
+# anonymous chat lounge
+# Copyright (C) <2020>  <jacotsu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+from collections import Counter
+from datetime import timedelta
+from utils import SingletonDecorator, LRUCache
+from event_bus import StaleStateSweep, StormStarted, StormEnded
+
+
+logger = logging.getLogger(__name__)
+
+
+@SingletonDecorator
+class NoticeRegistry:
+    '''
+    Remembers which notices (warnings) have been sent to which users, so that
+    the filters send each notice once instead of answering every message of a
+    spammer. Every kind of notice has its own time to live, past which the
+    notice can be sent again, and the registry holds at most MAX_ENTRIES
+    notices, the least recently used ones are dropped first.
+    No notice is sent during a storm
+    '''
+    MAX_ENTRIES = 10000
+
+    def __init__(self, event_bus):
+        self._notices = LRUCache(self.MAX_ENTRIES)
+        # kind -> default ttl in seconds, None means until forgotten
+        self._ttls = {}
+        self.suppressed = Counter()
+        self._storm_suppressed = None
+        event_bus.subscribe(StaleStateSweep, self._evict_stale)
+        event_bus.subscribe(StormStarted, self._on_storm_started)
+        event_bus.subscribe(StormEnded, self._on_storm_ended)
+
+    def __len__(self):
+        return len(self._notices)
+
+    def register_kind(self, kind: str, ttl: timedelta = None):
+        self._ttls[kind] = ttl.total_seconds() if ttl is not None else None
+
+    def may_notify(self, kind: str, user_id: int,
+                   ttl: timedelta = None) -> bool:
+        '''
+        Marks the notice as sent if it can be sent now, ttl overrides the
+        default one of the kind
+        @returns True if the notice can be sent
+        @raises KeyError if the kind is not registered
+        '''
+        ttl = ttl.total_seconds() if ttl is not None else self._ttls[kind]
+        storm_suppressed = self._storm_suppressed
+        if storm_suppressed is not None:
+            # Reported once the storm ends
+            storm_suppressed[kind] += 1
+            return False
+        if self._notices.add((kind, user_id), True, ttl):
+            return True
+        self.suppressed[kind] += 1
+        logger.debug(f'Suppressed {kind} notice to {user_id}')
+        return False
+
+    def forget(self, kind: str, user_id: int):
+        '''
+        The next notice of this kind will be sent to the user
+        '''
+        self._notices.pop((kind, user_id))
+
+    def _on_storm_started(self, event):
+        self._storm_suppressed = Counter()
+
+    def _on_storm_ended(self, event):
+        storm_suppressed, self._storm_suppressed = self._storm_suppressed, None
+        for kind, number in (storm_suppressed or {}).items():
+            event.shed[f'{kind}_notices'] += number
+
+    def _evict_stale(self, event):
+        event.reclaimed['notice_entries'] += self._notices.expire()
+        if self.suppressed:
+            logger.info(f'Suppressed notices: {dict(self.suppressed)}')
@@ -88,6 +88,11 @@ CREATE_ACTIVE_CAPTCHA_TABLE = '''
     ) WITHOUT ROWID;
 '''
 
+CREATE_ACTIVE_CAPTCHA_CREATION_TIME_INDEX = '''
+    CREATE INDEX IF NOT EXISTS active_captcha_creation_time_index
+    ON active_captcha_storage(unix_creation_time_date);
+'''
+
 CREATE_BAN_LOG_TABLE = '''
     CREATE TABLE IF NOT EXISTS ban_log (
         user_id INTEGER,
@@ -131,6 +136,35 @@ CREATE_ADMINISTRATIVE_POLLS_TABLE = '''
     ) WITHOUT ROWID;
 '''
 
+# Caches the user resolver's lookups, every resolved user is stored both under
+# its id and its username. Unknown usernames are stored with a NULL user_id
+CREATE_USER_RESOLVER_CACHE_TABLE = '''
+    CREATE TABLE IF NOT EXISTS user_resolver_cache (
+        lookup_key TEXT PRIMARY KEY,
+        user_id INTEGER,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        unix_resolution_date INTEGER NOT NULL
+    ) WITHOUT ROWID;
+'''
+
+# Users observed in the incoming updates
+CREATE_OBSERVED_USERS_TABLE = '''
+    CREATE TABLE IF NOT EXISTS observed_users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        unix_last_seen_date INTEGER NOT NULL
+    ) WITHOUT ROWID;
+'''
+
+CREATE_OBSERVED_USERS_USERNAME_INDEX = '''
+    CREATE INDEX IF NOT EXISTS observed_users_username_index
+    ON observed_users(username COLLATE NOCASE);
+'''
+
 CREATE_DATABASE_INFO_TABLE = '''
     CREATE TABLE IF NOT EXISTS database_info (
         key TEXT PRIMARY KEY,
@@ -279,6 +313,36 @@ IS_USER_ACTIVE = '''
     WHERE user_id = :user_id;
 '''
 
+# Everything the in memory user state store needs to know about the users.
+# member and unix_banned_until follow the same logic of the active_users and
+# banned_users views
+_SELECT_USER_STATES = '''
+    SELECT
+        users.user_id AS user_id,
+        IFNULL(permissions.permissions, 0) AS permissions,
+        IFNULL(roles.role_power, 0) AS role_power,
+        IFNULL((SELECT MAX(unix_join_date) FROM join_log
+                WHERE join_log.user_id = users.user_id), 0) >
+        IFNULL((SELECT MAX(unix_quit_date) FROM quit_log
+                WHERE quit_log.user_id = users.user_id), 0) AS member,
+        IFNULL((SELECT MAX(unix_end_date) FROM ban_log
+                WHERE ban_log.user_id = users.user_id
+                AND unix_start_date <= strftime("%s", 'now')*1E6), 0)/1E6
+        AS unix_banned_until,
+        IFNULL(captcha_status.passed, 0) AS captcha_passed
+    FROM users
+    LEFT JOIN permissions ON permissions.user_id = users.user_id
+    LEFT JOIN assigned_roles ON assigned_roles.user_id = users.user_id
+    LEFT JOIN roles ON roles.role_name = assigned_roles.role_name
+    LEFT JOIN captcha_status ON captcha_status.user_id = users.user_id
+'''
+
+GET_USER_STATES = _SELECT_USER_STATES + ';'
+
+GET_USER_STATE = _SELECT_USER_STATES + '''
+    WHERE users.user_id = :user_id;
+'''
+
 # ------------------------ [PERMISSIONS] ---------------------
 
 UPDATE_USER_PERMISSIONS = '''
@@ -294,102 +358,44 @@ GET_USER_PERMISSIONS = '''
 
 # ----------------------- [CAPTCHA] --------------------------
 
-SET_USER_FAILED_ATTEMPTS_FROM_CAPTCHA_STATUS = '''
-    WITH new (user_id, failed_attempts) AS (VALUES(:user_id, :failed_attempts))
-    REPLACE INTO captcha_status (user_id, failed_attempts,
-        total_failed_attempts, passed)
-    SELECT new.user_id, new.failed_attempts, old.total_failed_attempts,
-        old.passed
-    FROM new
-    LEFT JOIN captcha_status AS old USING (user_id);
-'''
-
-SET_USER_TOTAL_FAILED_ATTEMPTS_FROM_CAPTCHA_STATUS = '''
-    WITH new (user_id, total_failed_attempts) AS (VALUES(:user_id,
-        :total_failed_attempts))
-    REPLACE INTO captcha_status (user_id, failed_attempts,
-        total_failed_attempts, passed)
-    SELECT new.user_id, old.failed_attempts, new.total_failed_attempts,
-        old.passed
-    FROM new
-    LEFT JOIN captcha_status AS old USING (user_id);
-'''
-
-SET_USER_PASSED_FROM_CAPTCHA_STATUS = '''
-    WITH new (user_id, passed) AS (VALUES(:user_id, :passed))
-    REPLACE INTO captcha_status (user_id, failed_attempts,
-        total_failed_attempts, passed)
-    SELECT new.user_id, old.failed_attempts, old.total_failed_attempts,
-        new.passed
-    FROM new
-    LEFT JOIN captcha_status AS old USING (user_id);
-'''
-
-GET_USER_FAILED_ATTEMPTS_FROM_CAPTCHA_STATUS = '''
-    SELECT failed_attempts
-    FROM captcha_status
-    WHERE user_id = :user_id;
-'''
-
-GET_USER_TOTAL_FAILED_ATTEMPTS_FROM_CAPTCHA_STATUS = '''
-    SELECT total_failed_attempts
-    FROM captcha_status
-    WHERE user_id = :user_id;
-'''
-
-GET_USER_PASSED_FROM_CAPTCHA_STATUS = '''
-    SELECT passed
+GET_CAPTCHA_STATUS = '''
+    SELECT failed_attempts, total_failed_attempts, passed,
+        IFNULL(current_value, '') AS current_value,
+        IFNULL(unix_creation_time_date, 0)/1E6 AS unix_creation_time_date,
+        IFNULL(unix_last_try_time_date, 0)/1E6 AS unix_last_try_time_date
     FROM captcha_status
+    LEFT JOIN active_captcha_storage USING (user_id)
     WHERE user_id = :user_id;
 '''
 
-SET_USER_CURRENT_CAPTCHA_VALUE = '''
-    WITH new (user_id, current_value) AS (VALUES(:user_id,
-        :current_value))
-    REPLACE INTO active_captcha_storage (user_id, current_value,
-        unix_creation_time_date, unix_last_try_time_date)
-    SELECT new.user_id, new.current_value, old.unix_creation_time_date,
-        old.unix_last_try_time_date
-    FROM new
-    LEFT JOIN active_captcha_storage AS old USING (user_id);
+# Batched to keep the write transactions short
+# The solved and reset captchas have an empty current_value, the pending
+# ones are kept longer
+DELETE_EXPIRED_CAPTCHAS = '''
+    DELETE FROM active_captcha_storage
+    WHERE user_id IN (
+        SELECT user_id
+        FROM active_captcha_storage
+        WHERE MAX(unix_creation_time_date, unix_last_try_time_date) <
+            CASE WHEN current_value = ''
+                THEN :unix_cutoff_date*1E6
+                ELSE :unix_pending_cutoff_date*1E6
+            END
+        LIMIT :batch_size
+    );
 '''
 
-SET_USER_CURRENT_CAPTCHA_CREATION_TIME_DATE = '''
-    WITH new (user_id, unix_creation_time_date) AS (VALUES(:user_id,
-        :unix_creation_time_date*1E6))
-    REPLACE INTO active_captcha_storage (user_id, current_value,
-        unix_creation_time_date, unix_last_try_time_date)
-    SELECT new.user_id, old.current_value, new.unix_creation_time_date,
-        old.unix_last_try_time_date
-    FROM new
-    LEFT JOIN active_captcha_storage AS old USING (user_id);
+SAVE_CAPTCHA_STATUS = '''
+    REPLACE INTO captcha_status (user_id, failed_attempts,
+        total_failed_attempts, passed)
+    VALUES (:user_id, :failed_attempts, :total_failed_attempts, :passed);
 '''
 
-SET_USER_CURRENT_CAPTCHA_LAST_TRY_TIME_DATE = '''
-
-    WITH new (user_id, unix_last_try_time_date) AS (VALUES(:user_id,
-        :unix_last_try_time_date*1E6))
+SAVE_ACTIVE_CAPTCHA = '''
     REPLACE INTO active_captcha_storage (user_id, current_value,
         unix_creation_time_date, unix_last_try_time_date)
-    SELECT new.user_id, old.current_value, old.unix_creation_time_date,
-        new.unix_last_try_time_date
-    FROM new
-    LEFT JOIN active_captcha_storage AS old USING (user_id);
-'''
-GET_USER_CURRENT_CAPTCHA_VALUE = '''
-    SELECT current_value
-    FROM active_captcha_storage
-    WHERE user_id = :user_id;
-'''
-GET_USER_CURRENT_CAPTCHA_CREATION_TIME_DATE = '''
-    SELECT unix_creation_time_date/1E6 as unix_creation_time_date
-    FROM active_captcha_storage
-    WHERE user_id = :user_id;
-'''
-GET_USER_CURRENT_CAPTCHA_LAST_TRY_TIME_DATE = '''
-    SELECT unix_last_try_time_date/1E6 as unix_last_try_time_date
-    FROM active_captcha_storage
-    WHERE user_id = :user_id;
+    VALUES (:user_id, :current_value, :unix_creation_time_date*1E6,
+        :unix_last_try_time_date*1E6);
 '''
 
 # -------------------- [LOGGING] ------------------
@@ -444,6 +450,12 @@ GET_ROLES = '''
     ORDER BY role_power ASC;
 '''
 
+GET_ROLES_TABLE = '''
+    SELECT role_name, role_power, role_permissions
+    FROM roles
+    ORDER BY role_power ASC;
+'''
+
 DELETE_ROLE = '''
     DELETE FROM roles
     WHERE role_name = :role_name;
@@ -514,6 +526,13 @@ GET_USER_CHAT_DELAY = '''
     WHERE user_id = :user_id;
 '''
 
+# user_ids is a json array
+GET_USERS_CHAT_DELAYS = '''
+    SELECT user_id, chat_delay
+    FROM chat_delays
+    WHERE user_id IN (SELECT value FROM json_each(:user_ids));
+'''
+
 SET_USER_CHAT_DELAY = '''
     REPLACE INTO chat_delays (user_id, chat_delay)
     VALUES (:user_id, :chat_delay);
@@ -579,8 +598,62 @@ GET_ADMIN_POLL = '''
     WHERE poll_id = :poll_id;
 '''
 
+# ---------------------------- [USER RESOLVER] --------------------------------
+
+GET_CACHED_USER_INFO = '''
+    SELECT user_id, username, first_name, last_name,
+        unix_resolution_date/1E6 AS unix_resolution_date
+    FROM user_resolver_cache
+    WHERE lookup_key = :lookup_key
+    AND unix_resolution_date >= CASE WHEN user_id IS NULL
+        THEN :unix_negative_min_resolution_date*1E6
+        ELSE :unix_min_resolution_date*1E6
+    END;
+'''
+
+CACHE_USER_INFO = '''
+    REPLACE INTO user_resolver_cache (lookup_key, user_id, username,
+        first_name, last_name, unix_resolution_date)
+    VALUES (:lookup_key, :user_id, :username, :first_name, :last_name,
+        :unix_resolution_date*1E6);
+'''
+
+# ---------------------------- [OBSERVED USERS] -------------------------------
+
+REGISTER_OBSERVED_USER = '''
+    REPLACE INTO observed_users (user_id, username, first_name, last_name,
+        unix_last_seen_date)
+    VALUES (:user_id, :username, :first_name, :last_name,
+        :unix_last_seen_date*1E6);
+'''
+
+# Usernames can be reassigned, the most recent owner wins
+GET_OBSERVED_USER_BY_USERNAME = '''
+    SELECT user_id, username, first_name, last_name
+    FROM observed_users
+    WHERE username = :username COLLATE NOCASE
+    ORDER BY unix_last_seen_date DESC
+    LIMIT 1;
+'''
+
+GET_OBSERVED_USER_BY_ID = '''
+    SELECT user_id, username, first_name, last_name
+    FROM observed_users
+    WHERE user_id = :user_id;
+'''
+
 # --------------------------- [DATABASE INFO] ---------------------------------
 
 SET_DATABASE_VERSION = '''
     REPLACE INTO database_info(key, value) VALUES("version", "0.0.1")
 '''
+
+GET_DATABASE_INFO = '''
+    SELECT value
+    FROM database_info
+    WHERE key = :key;
+'''
+
+SET_DATABASE_INFO = '''
+    REPLACE INTO database_info(key, value) VALUES(:key, :value);
+'''
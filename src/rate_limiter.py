@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+#
+# anon_chat_bot is a telegram bot whose main function is to manage an
+# anonymous chat lounge
+# Copyright (C) <2020>  <jacotsu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import threading
+from collections import OrderedDict
+from time import monotonic_ns
+from utils import SingletonDecorator
+from event_bus import UserBanned, UserQuit, StaleStateSweep
+
+
+logger = logging.getLogger(__name__)
+
+
+@SingletonDecorator
+class RateLimiter:
+    '''
+    A token bucket rate limiter shared by all the AntiFloodFilter instances,
+    so that messages and commands draw from the same per user budget.
+    A bucket refills one token every interval and holds up to burst tokens.
+    Each bucket is stored as a single integer, the monotonic time in ns at
+    which it will be full again (generic cell rate algorithm). A full bucket
+    is the same as a missing one, so full buckets are dropped as they are met
+    '''
+    # Buckets inspected for expiry on every acquire
+    EXPIRY_STEPS = 2
+
+    def __init__(self, event_bus, burst: int = 1):
+        if burst < 1:
+            raise ValueError('The antiflood burst must be at least 1')
+        self._burst = burst
+        self._lock = threading.Lock()
+        # user_id -> time at which the bucket is full
+        self._full_at = OrderedDict()
+        for event_type in (UserBanned, UserQuit):
+            event_bus.subscribe(event_type, self._forget_user)
+        event_bus.subscribe(StaleStateSweep, self._evict_stale)
+
+    def __len__(self):
+        return len(self._full_at)
+
+    def acquire(self, user_id: int, interval_ns: int) -> int:
+        '''
+        Takes a token from the user's bucket
+        @returns 0 if the token has been taken, otherwise the ns to wait
+        before the next token is available
+        '''
+        now = monotonic_ns()
+        with self._lock:
+            self._expire_some(now)
+            full_at = max(self._full_at.get(user_id, now), now)
+            wait_time = full_at - (self._burst - 1) * interval_ns - now
+            if wait_time > 0:
+                return wait_time
+            self._full_at[user_id] = full_at + interval_ns
+            return 0
+
+    def _expire_some(self, now: int):
+        # The buckets are inspected round robin, the ones still refilling
+        # are moved to the back
+        for _ in range(min(self.EXPIRY_STEPS, len(self._full_at))):
+            user_id, full_at = next(iter(self._full_at.items()))
+            if full_at > now:
+                self._full_at.move_to_end(user_id)
+            else:
+                del self._full_at[user_id]
+
+    def _forget_user(self, event):
+        with self._lock:
+            self._full_at.pop(event.user_id, None)
+
+    def _evict_stale(self, event):
+        now = monotonic_ns()
+        with self._lock:
+            full_buckets = [user_id for user_id, full_at
+                            in self._full_at.items() if full_at <= now]
+            for user_id in full_buckets:
+                del self._full_at[user_id]
+        event.reclaimed['antiflood_entries'] += len(full_buckets)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+#
+# anon_chat_bot is a telegram bot whose main function is to manage an
+# anonymous chat lounge
+# Copyright (C) <2020>  <jacotsu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Iterable
+from permissions import Permissions
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class RoleEntry:
+    name: str
+    power: int
+    permissions: Permissions
+
+
+class RoleTable:
+    '''
+    An immutable snapshot of all the roles. The DatabaseManager replaces it
+    with a new one whenever a role is edited, so the readers never see a
+    partially updated table
+    '''
+    def __init__(self, rows: Iterable):
+        # Rows are expected to be sorted by power
+        self._roles = MappingProxyType({
+            row['role_name']: RoleEntry(
+                row['role_name'],
+                int(row['role_power']),
+                Permissions(row['role_permissions'])
+            ) for row in rows
+        })
+        logger.debug(f'Loaded {len(self._roles)} roles')
+
+    def __contains__(self, role_name):
+        return role_name in self._roles
+
+    def __getitem__(self, role_name) -> RoleEntry:
+        return self._roles[role_name]
+
+    def __iter__(self):
+        return iter(self._roles.values())
+
+    def __len__(self):
+        return len(self._roles)
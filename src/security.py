@@ -25,12 +25,12 @@ logger = logging.getLogger(__name__)
 
 
 def is_hierarchy_respected(agent: User, target: User):
-    if target.role.power < agent.role.power:
+    if target.power < agent.power:
         return True
     return False
 
 def is_role_hierarchy_respected(agent: User, target_role: Role):
-    if agent.role.power > target_role.power:
+    if agent.power > target_role.power:
         if target_role.permissions in agent.permissions:
             return True
     return False
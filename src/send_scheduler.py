@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+#
+# anon_chat_bot is a telegram bot whose main function is to manage an
+# anonymous chat lounge
+# Copyright (C) <2020>  <jacotsu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import logging
+import threading
+from collections import deque
+from heapq import heappush, heappop
+from itertools import count
+from time import monotonic
+from typing import Callable
+from telegram.error import TelegramError, RetryAfter
+from event_bus import StaleStateSweep
+
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    '''
+    Allows rate events per second on average, in bursts of up to burst
+    events
+    '''
+    __slots__ = ('_rate', '_burst', '_tokens', '_updated')
+
+    def __init__(self, rate: float, burst: int, now: float):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._updated = now
+
+    def _refill(self, now: float):
+        self._tokens = min(self._burst,
+                           self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def wait_time(self, now: float) -> float:
+        '''
+        @returns The seconds until a token is available, 0 if one is
+        '''
+        self._refill(now)
+        return max(0., (1 - self._tokens) / self._rate)
+
+    def take(self, now: float):
+        self._refill(now)
+        self._tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self._tokens >= self._burst
+
+
+class _Chat:
+    __slots__ = ('bucket', 'pending', 'scheduled', 'busy')
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        # (callback, args, kwargs) of the messages to send
+        self.pending = deque()
+        # The chat is in the ready heap
+        self.scheduled = False
+        # A message is being sent to the chat
+        self.busy = False
+
+
+class SendScheduler:
+    '''
+    Sends the messages through a pool of sender threads, within telegram's
+    flood limits: a global token bucket limits the messages sent per
+    second, and a token bucket for each chat the messages sent to a chat.
+    The messages of a chat are sent one at a time and in order, the other
+    chats aren't delayed by a chat that is over its limit
+    '''
+    def __init__(self, event_bus, rate: float = 29, burst: int = 1,
+                 chat_rate: float = 1, chat_burst: int = 3,
+                 threads: int = 8):
+        self._bucket = TokenBucket(rate, burst, monotonic())
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._chats = {}
+        # (ready time, sequence number, chat id) of the scheduled chats, the
+        # sequence number keeps the chats ready at the same time in order
+        self._ready = []
+        self._sequence = count()
+        self._pending = 0
+        self._closed = False
+        lock = threading.Lock()
+        self._condition = threading.Condition(lock)
+        self._drained = threading.Condition(lock)
+        self._threads = [
+            threading.Thread(target=self._send_messages,
+                             name=f'sender_{number}',
+                             daemon=True)
+            for number in range(max(threads, 1))
+        ]
+        for thread in self._threads:
+            thread.start()
+        event_bus.subscribe(StaleStateSweep, self._on_stale_state_sweep)
+
+    @property
+    def pending(self) -> int:
+        '''
+        @returns The number of messages not sent yet
+        '''
+        return self._pending
+
+    def submit(self, chat_id: int, callback: Callable, *args, **kwargs):
+        '''
+        Queues a message for the chat, callback(*args, **kwargs) sends it
+        '''
+        with self._condition:
+            chat = self._chats.get(chat_id)
+            if not chat:
+                chat = _Chat(TokenBucket(self._chat_rate, self._chat_burst,
+                                         monotonic()))
+                self._chats[chat_id] = chat
+            chat.pending.append((callback, args, kwargs))
+            self._pending += 1
+            self._schedule(chat_id, chat)
+
+    def stop(self, timeout: float = None):
+        '''
+        Waits up to timeout seconds for the pending messages to be sent,
+        the messages still pending afterwards are dropped
+        '''
+        with self._condition:
+            self._drained.wait_for(lambda: not self._pending, timeout)
+            if self._pending:
+                logger.warning(f'Dropped {self._pending} pending messages')
+            self._closed = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def _schedule(self, chat_id: int, chat: _Chat, delay: float = 0):
+        if chat.pending and not chat.scheduled and not chat.busy:
+            now = monotonic()
+            ready_time = now + max(delay, chat.bucket.wait_time(now))
+            heappush(self._ready, (ready_time, next(self._sequence), chat_id))
+            chat.scheduled = True
+            self._condition.notify()
+
+    def _next_message(self):
+        '''
+        Blocks until a message can be sent, takes the tokens to send it
+        @returns chat id, chat and message, None once the scheduler is closed
+        '''
+        with self._condition:
+            while not self._closed:
+                if not self._ready:
+                    self._condition.wait()
+                    continue
+
+                now = monotonic()
+                ready_time, _, chat_id = self._ready[0]
+                wait_time = max(ready_time - now,
+                                self._bucket.wait_time(now))
+                if wait_time > 0:
+                    self._condition.wait(wait_time)
+                    continue
+
+                heappop(self._ready)
+                chat = self._chats[chat_id]
+                chat.scheduled = False
+                chat.busy = True
+                self._bucket.take(now)
+                chat.bucket.take(now)
+                if self._ready:
+                    # Another chat may be ready too
+                    self._condition.notify()
+                return chat_id, chat, chat.pending.popleft()
+            return None
+
+    def _send_messages(self):
+        while True:
+            next_message = self._next_message()
+            if not next_message:
+                break
+            chat_id, chat, message = next_message
+            callback, args, kwargs = message
+            delay = 0
+            try:
+                callback(*args, **kwargs)
+            except RetryAfter as e:
+                logger.warning(f'Flood limit exceeded for {chat_id}, '
+                               f'retrying in {e.retry_after}s')
+                delay = e.retry_after
+            except TelegramError as e:
+                logger.warning(f'Cannot send a message to {chat_id}: {e}')
+            except Exception:
+                logger.exception(f'Cannot send a message to {chat_id}')
+
+            with self._condition:
+                if delay:
+                    chat.pending.appendleft(message)
+                else:
+                    self._pending -= 1
+                    if not self._pending:
+                        self._drained.notify_all()
+                chat.busy = False
+                self._schedule(chat_id, chat, delay)
+
+    def _on_stale_state_sweep(self, event: StaleStateSweep):
+        # The chats whose bucket is full can be forgotten, they would get a
+        # full bucket anyway
+        now = monotonic()
+        with self._condition:
+            stale_chats = [
+                chat_id for chat_id, chat in self._chats.items()
+                if not chat.pending and not chat.busy and
+                chat.bucket.is_full(now)
+            ]
+            for chat_id in stale_chats:
+                del self._chats[chat_id]
+        event.reclaimed['send_buckets'] += len(stale_chats)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+#
+# anon_chat_bot is a telegram bot whose main function is to manage an
+# anonymous chat lounge
+# Copyright (C) <2020>  <jacotsu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import logging
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from functools import cached_property
+from typing import Iterable
+from weakref import WeakSet
+from telegram import Update, Message
+from custom_dataclasses import User, CaptchaStatus
+from event_bus import ChatDelayChanged
+from permissions import Permissions
+
+
+logger = logging.getLogger(__name__)
+
+# The state of the users that aren't in the database yet
+_UNKNOWN_USER_STATE = {
+    'permissions': Permissions.NONE,
+    'role_power': 0,
+    'member': False,
+    'banned_until': 0,
+    'captcha_passed': False
+}
+
+
+class SenderContext:
+    '''
+    The state of the sender of an update, shared by all the filters and
+    handlers that process the update. Every piece of state is loaded on first
+    use and then reused. Permissions, ban, membership and captcha outcome
+    come from the in memory user state store, reading them doesn't create the
+    sender in the database, only accessing user does
+    '''
+    def __init__(self, database_manager, message: Message):
+        self._db_man = database_manager
+        self._message = message
+
+    @cached_property
+    def user(self) -> User:
+        return User(self._db_man, self._message.from_user)
+
+    @cached_property
+    def _state(self) -> dict:
+        try:
+            return self._db_man.get_user_state(self._message.from_user.id)
+        except ValueError:
+            return _UNKNOWN_USER_STATE
+
+    @property
+    def is_known(self) -> bool:
+        '''
+        Whether the sender was in the database when the update arrived
+        '''
+        return self._state is not _UNKNOWN_USER_STATE
+
+    @cached_property
+    def permissions(self) -> Permissions:
+        return self._state['permissions']
+
+    @cached_property
+    def is_banned(self) -> bool:
+        return self._state['banned_until'] > \
+            datetime.now(timezone.utc).timestamp()
+
+    @property
+    def captcha_passed(self) -> bool:
+        return self._state['captcha_passed']
+
+    @cached_property
+    def is_active(self) -> bool:
+        return self._state['member'] and self.captcha_passed and \
+            not self.is_banned
+
+    @property
+    def captcha_status(self) -> CaptchaStatus:
+        # Memoized by the user
+        return self.user.captcha_status
+
+    @cached_property
+    def chat_delay(self) -> timedelta:
+        '''
+        The user's own delay between messages, None if it has not got one
+        '''
+        if not self.is_known:
+            return None
+        try:
+            return self.user.chat_delay
+        except ValueError:
+            return None
+
+
+def get_sender_context(database_manager,
+                       update_or_message) -> SenderContext:
+    '''
+    @returns The sender context attached to the update's message, it's
+    created on first use
+    '''
+    if isinstance(update_or_message, Update):
+        message = update_or_message.effective_message
+    else:
+        message = update_or_message
+
+    # Private, so that it's not serialized with the message
+    try:
+        return message._sender_context
+    except AttributeError:
+        message._sender_context = SenderContext(database_manager, message)
+        return message._sender_context
+
+
+class SenderPrefetcher:
+    '''
+    Creates the sender contexts of a batch of updates and loads the chat
+    delays of all the senders with one query, instead of one query per
+    update. The previous updates of a sender may still be waiting in its
+    lane, so a prefetched chat delay is dropped when the delay of its user
+    changes, and loaded again when the update is processed. The captcha
+    statuses aren't prefetched, the previous updates may change them
+    '''
+    def __init__(self, database_manager):
+        self._db_man = database_manager
+        self._lock = threading.Lock()
+        # user_id -> contexts with a prefetched chat delay, the processed
+        # ones vanish with their update
+        self._prefetched = defaultdict(WeakSet)
+        database_manager.event_bus.subscribe(ChatDelayChanged,
+                                             self._on_chat_delay_changed)
+
+    def __call__(self, updates: Iterable):
+        with self._lock:
+            for user_id in [x for x, y in self._prefetched.items() if not y]:
+                del self._prefetched[user_id]
+
+        contexts = [
+            get_sender_context(self._db_man, update)
+            for update in updates
+            if isinstance(update, Update) and update.effective_message and
+            update.effective_message.from_user
+        ]
+
+        known_ids = set()
+        for context in contexts:
+            user_id = context._message.from_user.id
+            # The state itself is read when the update is processed, the
+            # previous updates of the sender may change it
+            try:
+                self._db_man.get_user_state(user_id)
+            except ValueError:
+                continue
+            known_ids.add(user_id)
+
+        if not known_ids:
+            return
+        chat_delays = self._db_man.get_users_chat_delays(known_ids)
+
+        with self._lock:
+            for context in contexts:
+                user_id = context._message.from_user.id
+                if user_id in known_ids:
+                    context.chat_delay = chat_delays.get(user_id)
+                    self._prefetched[user_id].add(context)
+
+    def _on_chat_delay_changed(self, event: ChatDelayChanged):
+        with self._lock:
+            contexts = list(self._prefetched.pop(event.user_id, ()))
+        for context in contexts:
+            # chat_delay is loaded again on the next access
+            context.__dict__.pop('chat_delay', None)
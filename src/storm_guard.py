@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+#
+# anon_chat_bot is a telegram bot whose main function is to manage an
+# anonymous chat lounge
+# Copyright (C) <2020>  <jacotsu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import threading
+from collections import Counter
+from datetime import timedelta
+from time import monotonic
+from pytimeparse.timeparse import timeparse
+from event_bus import StormStarted, StormEnded
+
+
+logger = logging.getLogger(__name__)
+
+
+class StormGuard:
+    '''
+    Detects the storms of updates from unverified users, as during a raid,
+    and tells the other components through the StormStarted and StormEnded
+    events to save their resources while the storm lasts.
+    A storm starts when the rate of unverified updates exceeds the threshold
+    and ends when it has stayed below it for the calm down time.
+    Meant to be ticked every second
+    '''
+    def __init__(self, event_bus, config):
+        self._event_bus = event_bus
+        storm_config = config.get("StormMode", {})
+        # Unverified updates per second, 0 disables the storm mode
+        self._threshold = float(storm_config.get("Threshold", 30))
+        self._calm_down_time = timeparse(
+            storm_config.get("CalmDownTime", "1m"))
+        self._lock = threading.Lock()
+        self._unverified_updates = 0
+        self._last_tick_time = monotonic()
+        self._start_time = None
+        self._calm_since = None
+        self.is_active = False
+
+    def record_unverified_update(self):
+        with self._lock:
+            self._unverified_updates += 1
+
+    def tick(self) -> float:
+        '''
+        Starts or ends the storm mode according to the rate of unverified
+        updates since the previous tick
+        @returns The rate of unverified updates per second
+        '''
+        now = monotonic()
+        with self._lock:
+            rate = self._unverified_updates / \
+                max(now - self._last_tick_time, 1E-3)
+            self._unverified_updates = 0
+            self._last_tick_time = now
+
+        if self._threshold and rate > self._threshold:
+            self._calm_since = None
+            if not self.is_active:
+                self._start_storm(now, rate)
+        elif self.is_active:
+            if self._calm_since is None:
+                self._calm_since = now
+            elif now - self._calm_since >= self._calm_down_time:
+                self._end_storm(now)
+        return rate
+
+    def _start_storm(self, now: float, rate: float):
+        self.is_active = True
+        self._start_time = now
+        logger.warning(f'Storm mode started, {rate:.1f} unverified updates '
+                       'per second')
+        self._event_bus.publish(StormStarted(rate))
+
+    def _end_storm(self, now: float):
+        self.is_active = False
+        self._calm_since = None
+        shed = Counter()
+        self._event_bus.publish(StormEnded(shed))
+        duration = timedelta(seconds=round(now - self._start_time))
+        logger.warning(f'Storm mode ended after {duration}, shed ' + (
+            ', '.join(f'{number} {kind}' for kind, number in shed.items())
+            or 'nothing'))
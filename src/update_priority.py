@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+#
+# anon_chat_bot is a telegram bot whose main function is to manage an
+# anonymous chat lounge
+# Copyright (C) <2020>  <jacotsu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+from enum import IntEnum
+from typing import Callable
+from telegram import Update, MessageEntity
+from permissions import Permissions
+
+
+logger = logging.getLogger(__name__)
+
+
+class UpdatePriority(IntEnum):
+    '''
+    The scheduling classes of the inbound updates, lower values are served
+    first
+    '''
+    MODERATION = 0
+    COMMAND = 1
+    CHAT = 2
+
+
+MODERATION_PERMISSIONS = int(Permissions.BAN | Permissions.KICK |
+                             Permissions.DELETE_MESSAGE)
+
+
+def classify_update(database_manager, required_permissions: Callable,
+                    update) -> UpdatePriority:
+    '''
+    The commands that require the permission to ban, kick or delete messages
+    are moderation updates when the sender has it, the other commands are
+    command updates and everything else is a chat update.
+    required_permissions maps a command name to its permissions mask, and
+    raises KeyError for unknown commands
+    '''
+    if not isinstance(update, Update) or not update.message or \
+       not update.message.from_user:
+        return UpdatePriority.CHAT
+
+    message = update.message
+    entities = message.entities
+    if not entities or entities[0].type != MessageEntity.BOT_COMMAND or \
+       entities[0].offset != 0:
+        return UpdatePriority.CHAT
+
+    cmd_name = message.text[1:entities[0].length].partition('@')[0].lower()
+    try:
+        moderation_permissions = required_permissions(cmd_name) & \
+            MODERATION_PERMISSIONS
+    except KeyError:
+        return UpdatePriority.COMMAND
+    if not moderation_permissions:
+        return UpdatePriority.COMMAND
+
+    # Read from the store directly, the sender context would keep the state
+    # it had when the update was queued
+    try:
+        state = database_manager.get_user_state(message.from_user.id)
+    except ValueError:
+        return UpdatePriority.COMMAND
+    if moderation_permissions & ~int(state['permissions']):
+        return UpdatePriority.COMMAND
+    return UpdatePriority.MODERATION
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+#
+# anon_chat_bot is a telegram bot whose main function is to manage an
+# anonymous chat lounge
+# Copyright (C) <2020>  <jacotsu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import threading
+from datetime import datetime
+from telegram import User as tg_User
+
+
+logger = logging.getLogger(__name__)
+
+
+class UserIndex:
+    '''
+    A local index of the users seen by the bot, built from the from_user of
+    the incoming updates. It allows resolving usernames without a telegram
+    user session.
+    Observed users are buffered and written in batches, a user observed
+    many times between two flushes is written only once
+    '''
+    def __init__(self, database_manager, batch_size: int = 100):
+        self._db_man = database_manager
+        self._batch_size = batch_size
+        self._lock = threading.Lock()
+        # user_id -> observed user dict
+        self._pending = {}
+
+    def observe(self, tg_user: tg_User):
+        if not tg_user or tg_user.is_bot:
+            return
+
+        with self._lock:
+            self._pending[tg_user.id] = {
+                'id': tg_user.id,
+                'username': tg_user.username,
+                'first_name': tg_user.first_name,
+                'last_name': tg_user.last_name,
+                'last_seen_date': datetime.utcnow()
+            }
+            must_flush = len(self._pending) >= self._batch_size
+
+        if must_flush:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            observed_users = list(self._pending.values())
+            self._pending = {}
+
+        if observed_users:
+            self._db_man.register_observed_users(observed_users)
+            logger.debug(f'Flushed {len(observed_users)} observed users')
+
+    def get(self, username_or_id) -> dict:
+        '''
+        @returns The user info dict of the last observation of the user
+        @raises KeyError if the user has never been observed
+        '''
+        is_id = isinstance(username_or_id, int)
+        if not is_id:
+            username_or_id = username_or_id.strip().lstrip('@').lower()
+
+        with self._lock:
+            if is_id:
+                if username_or_id in self._pending:
+                    return self._to_user_info(self._pending[username_or_id])
+            else:
+                # There are at most batch_size pending users
+                for observed_user in self._pending.values():
+                    if observed_user['username'] and \
+                       observed_user['username'].lower() == username_or_id:
+                        return self._to_user_info(observed_user)
+
+        try:
+            if is_id:
+                observed_user = self._db_man.get_observed_user_by_id(
+                    username_or_id)
+            else:
+                observed_user = self._db_man.get_observed_user_by_username(
+                    username_or_id)
+        except ValueError:
+            raise KeyError(username_or_id)
+        return self._to_user_info(observed_user)
+
+    @staticmethod
+    def _to_user_info(observed_user) -> dict:
+        return {
+            'first_name': observed_user['first_name'],
+            'last_name': observed_user['last_name'],
+            'username': observed_user['username'],
+            'id': observed_user['id']
+        }
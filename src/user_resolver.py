@@ -21,19 +21,27 @@
 import logging
 import asyncio
 import threading
+import concurrent.futures
+from math import ceil
+from collections import Counter
+from datetime import datetime, timedelta
 from os.path import exists
-from telegram import Update, Message
-from telethon.sync import TelegramClient
-from utils import SingletonDecorator, split_cmd_line
+from time import monotonic
+from pytimeparse.timeparse import timeparse
+from telegram import Update, Message, MessageEntity, User as tg_User
+from telethon import TelegramClient
+from telethon.errors import FloodWaitError, RPCError
+from utils import SingletonDecorator, LRUCache, split_cmd_line
+from user_index import UserIndex
 import custom_dataclasses
 from custom_exceptions import UserResolverError
 
 logger = logging.getLogger(__name__)
 
 # Mixing telethon and python telegram bot is not ideal since the former
-# uses asyncio and the latter threads. Asyncio should be more efficient but
-# the python telegram bot's filters are really handy. This hybrid form will do
-# for the moment
+# uses asyncio and the latter threads. Telethon is not thread safe, so a
+# single client lives in an event loop that runs on its own thread, the
+# python telegram bot's workers submit their lookups to that loop
 @SingletonDecorator
 class UserResolver:
     def __init__(self, database_manager, config):
@@ -41,31 +49,168 @@ class UserResolver:
         self._api_id = config["UsernameResolver"]["ApiId"]
         self._api_hash = config["UsernameResolver"]["ApiHash"]
         self._session_path = config["UsernameResolver"]["SessionPath"]
-        self._threads_data = {}
-
-    def _init_thread_event_loop(self):
-        '''
-        !!!MESS ALERT!!
-        Every thread needs its own telethon client because telethon is not
-        thread safe
-        '''
-        thread_id = threading.get_ident()
-        if thread_id not in self._threads_data:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            if self._api_id and self._api_hash and exists(self._session_path):
-                client = TelegramClient(
-                    self._session_path, self._api_id, self._api_hash, timeout=2
-                )
-                logger.debug('Initialized user resolver with username support')
-            else:
-                client = None
-                logger.info('User resolver is disabled')
 
-            self._threads_data[thread_id] = {
-                'loop': loop,
-                'client': client
-            }
+        resolver_config = config["UsernameResolver"]
+        self._request_timeout = timeparse(
+            resolver_config.get("RequestTimeout", "5s"))
+        # After this many consecutive failures the lookups fail fast for
+        # the cooldown, which doubles at every new failure
+        self._circuit_breaker_threshold = int(
+            resolver_config.get("CircuitBreakerThreshold", 3))
+        self._circuit_breaker_cooldown = timeparse(
+            resolver_config.get("CircuitBreakerCooldown", "30s"))
+        # Maximum number of concurrent lookups of a resolve_many call
+        self._max_concurrent_lookups = int(
+            resolver_config.get("MaxConcurrentLookups", 8))
+        # The lanes look up users concurrently
+        self._circuit_lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._circuit_open_until = 0
+        self._loop = None
+        self._client = None
+        if self._api_id and self._api_hash and exists(self._session_path):
+            self._start_client_thread()
+            logger.debug('Initialized user resolver with username support')
+        else:
+            logger.info('User resolver is disabled')
+
+        self._cache_ttl = timedelta(seconds=timeparse(
+            resolver_config.get("CacheTTL", "1d")))
+        self._negative_cache_ttl = timedelta(seconds=timeparse(
+            resolver_config.get("NegativeCacheTTL", "1h")))
+        self._cache = LRUCache(int(resolver_config.get("CacheSize", 1024)),
+                               self._cache_ttl.total_seconds())
+        # Every lookup is either a cache hit, a network call or rejected
+        # while the circuit breaker is open
+        self.lookup_stats = Counter()
+        self.user_index = UserIndex(
+            database_manager,
+            int(resolver_config.get("IndexBatchSize", 100))
+        )
+
+    def observe_update(self, update: Update, context=None):
+        '''
+        Records the sender of the update in the local user index, meant to
+        be used as a TypeHandler callback
+        '''
+        if update.effective_user:
+            self.user_index.observe(update.effective_user)
+
+    def _start_client_thread(self):
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(
+            target=self._loop.run_forever,
+            name='user_resolver',
+            daemon=True
+        ).start()
+        asyncio.run_coroutine_threadsafe(
+            self._create_client(), self._loop).result()
+
+    async def _create_client(self):
+        # Created inside the loop so that it binds to it. Flood waits are
+        # handled by the circuit breaker instead of sleeping in the loop
+        self._client = TelegramClient(
+            self._session_path, self._api_id, self._api_hash,
+            flood_sleep_threshold=0
+        )
+        self._lookups_semaphore = asyncio.Semaphore(
+            self._max_concurrent_lookups)
+
+    async def _get_entity(self, username_or_id):
+        if not self._client.is_connected():
+            await self._client.connect()
+        return await self._client.get_entity(username_or_id)
+
+    async def _get_entities(self, usernames_or_ids):
+        '''
+        @returns The entities in the same order of usernames_or_ids, a
+        failed lookup is returned as its exception
+        '''
+        if not self._client.is_connected():
+            await self._client.connect()
+
+        async def get_entity(username_or_id):
+            async with self._lookups_semaphore:
+                return await self._client.get_entity(username_or_id)
+
+        return await asyncio.gather(
+            *map(get_entity, usernames_or_ids),
+            return_exceptions=True
+        )
+
+    def _open_circuit(self, seconds: float):
+        with self._circuit_lock:
+            self._circuit_open_until = max(self._circuit_open_until,
+                                           monotonic() + seconds)
+        logger.warning(f'User resolution suspended for {seconds}s')
+
+    def _record_failure(self):
+        with self._circuit_lock:
+            self._consecutive_failures += 1
+            exceeding_failures = self._consecutive_failures - \
+                self._circuit_breaker_threshold
+        if exceeding_failures >= 0:
+            self._open_circuit(self._circuit_breaker_cooldown *
+                               2**min(exceeding_failures, 6))
+
+    def _record_success(self):
+        with self._circuit_lock:
+            self._consecutive_failures = 0
+
+    def _call(self, coroutine_function, *args, timeout: float = None):
+        '''
+        Runs the coroutine on the client's loop and waits for its result,
+        for at most timeout seconds (RequestTimeout by default)
+        @raises UserResolverError if the resolver is not configured, the call
+        times out or fails, or telegram is throttling the lookups
+        '''
+        if not self._client:
+            raise UserResolverError('Username resolution is not configured')
+
+        with self._circuit_lock:
+            retry_after = self._circuit_open_until - monotonic()
+        if retry_after > 0:
+            self.lookup_stats['rejected_calls'] += 1
+            raise UserResolverError('Username resolution is temporarily '
+                                    f'unavailable, retry in {retry_after:.0f}s')
+
+        self.lookup_stats['network_calls'] += 1
+        future = asyncio.run_coroutine_threadsafe(
+            coroutine_function(*args), self._loop)
+        try:
+            result = future.result(timeout or self._request_timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            self._record_failure()
+            raise UserResolverError('Username resolution timed out')
+        except FloodWaitError as e:
+            self._open_circuit(e.seconds)
+            raise UserResolverError('Username resolution is temporarily '
+                                    f'unavailable, retry in {e.seconds}s')
+        except (ConnectionError, OSError):
+            self._record_failure()
+            raise UserResolverError('Username resolution failed')
+        except RPCError as e:
+            # Telegram answered, with an error
+            self._record_success()
+            logger.warning(f'Username resolution failed: {e}')
+            raise UserResolverError('Username resolution failed')
+        except ValueError:
+            # Telegram answered, the entity just doesn't exist
+            self._record_success()
+            raise
+        self._record_success()
+        return result
+
+    def close(self):
+        '''
+        Disconnects the client and stops its event loop
+        '''
+        if self._client:
+            asyncio.run_coroutine_threadsafe(
+                self._client.disconnect(), self._loop
+            ).result(self._request_timeout)
+            self._loop.call_soon_threadsafe(self._loop.stop)
 
     def acquire_target_user_from_cmd(
             self,
@@ -86,7 +231,16 @@ class UserResolver:
             return self.resolve(user.id)
         else:
             if split_cmd_len > target_position:
-                return self.resolve(split_cmd[target_position].strip())
+                target = split_cmd[target_position].strip()
+                # Users without an username can be mentioned only through
+                # text mentions, which already carry the user
+                for entity, text in update.message.parse_entities(
+                        [MessageEntity.TEXT_MENTION]).items():
+                    if text.strip() == target:
+                        self.user_index.observe(entity.user)
+                        return custom_dataclasses.User(self._db_man,
+                                                       entity.user)
+                return self.resolve(target)
             else:
                 raise ValueError('The command string is too short to contain'
                                  'the target word '
@@ -98,19 +252,9 @@ class UserResolver:
                 return custom_dataclasses.User(
                     self._db_man, int(value_or_update), resolver=self)
             except ValueError:
-                self._init_thread_event_loop()
-                thread_id = threading.get_ident()
-                if self._threads_data[thread_id]['client']:
-                    with self._threads_data[thread_id]['client'] as tg_client:
-                        try:
-                            peer_id = tg_client.get_peer_id(value_or_update)
-                            return custom_dataclasses.User(
-                                self._db_man, peer_id, resolver=self)
-                        except ValueError:
-                            raise UserResolverError('Invalid username/user_id')
-                else:
-                    raise UserResolverError('Username resolution is not '
-                                            'configured')
+                info = self.get_user_info(value_or_update)
+                return custom_dataclasses.User(
+                    self._db_man, info['id'], resolver=self)
         elif type(value_or_update) == Update:
             return custom_dataclasses.User(
                 self._db_man, value_or_update.message.from_user)
@@ -120,21 +264,194 @@ class UserResolver:
         else:
             raise ValueError(f'{value_or_update}\'s type is wrong')
 
-    def get_user_info(self, username_or_id):
+    def resolve_many(self, tokens) -> list:
+        '''
+        Resolves many usernames/user ids at once, the empty tokens are
+        skipped
+        @returns A list in the same order of the non empty tokens containing
+        either the resolved User or the UserResolverError of each token
+        '''
+        usernames_or_ids = []
+        for token in tokens:
+            token = str(token).strip()
+            if not token:
+                continue
+            try:
+                usernames_or_ids.append(int(token))
+            except ValueError:
+                usernames_or_ids.append(token)
+
+        users = []
+        for username_or_id, info in zip(usernames_or_ids,
+                                        self.get_users_info(usernames_or_ids)):
+            if isinstance(info, UserResolverError):
+                # Like resolve, a user id is valid even if it can't be
+                # resolved
+                if isinstance(username_or_id, int) and username_or_id > 0:
+                    users.append(custom_dataclasses.User(self._db_man,
+                                                         username_or_id))
+                else:
+                    users.append(info)
+            else:
+                users.append(custom_dataclasses.User(
+                    self._db_man,
+                    tg_User(info['id'], info['first_name'], False,
+                            last_name=info['last_name'],
+                            username=info['username'])
+                ))
+        return users
+
+    @staticmethod
+    def _get_lookup_key(username_or_id) -> str:
+        if isinstance(username_or_id, int):
+            return str(username_or_id)
+        return username_or_id.strip().lstrip('@').lower()
+
+    def _get_cached_user_info(self, lookup_key: str) -> dict:
+        '''
+        Looks up the in memory cache first and then the database one
+        @raises KeyError on a cache miss
+        '''
+        try:
+            info = self._cache.get(lookup_key)
+            self.lookup_stats['memory_hits'] += 1
+            return info
+        except KeyError:
+            pass
 
-        thread_id = threading.get_ident()
-        self._init_thread_event_loop()
-        if self._threads_data[thread_id]['client']:
-            with self._threads_data[thread_id]['client'] as tg_client:
-                try:
-                    telethon_user = tg_client.get_entity(username_or_id)
-                except ValueError:
-                    raise UserResolverError('Invalid username/user_id')
-                return {
-                    'first_name': telethon_user.first_name,
-                    'last_name': telethon_user.last_name,
-                    'username': telethon_user.username,
-                    'id': telethon_user.id
-                }
+        try:
+            info, resolution_date = self._db_man.get_cached_user_info(
+                lookup_key, self._cache_ttl, self._negative_cache_ttl)
+        except ValueError:
+            raise KeyError(lookup_key)
+
+        # The entry expires from memory when it expires from the database
+        age = datetime.utcnow() - resolution_date
+        if info['id']:
+            ttl = self._cache_ttl - age
         else:
-            raise UserResolverError('Username resolution is not configured')
+            info = None
+            ttl = self._negative_cache_ttl - age
+        self._cache.put(lookup_key, info, max(ttl.total_seconds(), 0))
+        self.lookup_stats['database_hits'] += 1
+        return info
+
+    def _cache_user_info(self, lookup_key: str, info: dict = None):
+        if info:
+            lookup_keys = {lookup_key, str(info['id'])}
+            if info['username']:
+                lookup_keys.add(info['username'].lower())
+            for key in lookup_keys:
+                self._cache.put(key, info)
+        else:
+            lookup_keys = [lookup_key]
+            self._cache.put(lookup_key, None,
+                            self._negative_cache_ttl.total_seconds())
+        self._db_man.cache_user_info(lookup_keys, info)
+
+    def _get_local_user_info(self, username_or_id, lookup_key: str) -> dict:
+        '''
+        Looks up the user index and then the caches
+        @raises KeyError if the user is unknown locally
+        @raises UserResolverError if the user is known not to exist
+        '''
+        try:
+            info = self.user_index.get(username_or_id)
+            self.lookup_stats['index_hits'] += 1
+            logger.debug(f'{username_or_id} resolved from the user index')
+            return info
+        except KeyError:
+            pass
+
+        info = self._get_cached_user_info(lookup_key)
+        logger.debug(f'{lookup_key} resolved from the cache')
+        if not info:
+            raise UserResolverError('Invalid username/user_id')
+        return info
+
+    @staticmethod
+    def _entity_to_user_info(telethon_user) -> dict:
+        return {
+            'first_name': telethon_user.first_name,
+            'last_name': telethon_user.last_name,
+            'username': telethon_user.username,
+            'id': telethon_user.id
+        }
+
+    def get_user_info(self, username_or_id):
+        lookup_key = self._get_lookup_key(username_or_id)
+        try:
+            return self._get_local_user_info(username_or_id, lookup_key)
+        except KeyError:
+            pass
+
+        logger.debug(f'Resolving {lookup_key} through telegram')
+        try:
+            telethon_user = self._call(self._get_entity, username_or_id)
+        except ValueError:
+            self._cache_user_info(lookup_key)
+            raise UserResolverError('Invalid username/user_id')
+
+        info = self._entity_to_user_info(telethon_user)
+        self._cache_user_info(lookup_key, info)
+        return info
+
+    def get_users_info(self, usernames_or_ids) -> list:
+        '''
+        Batched version of get_user_info: duplicated inputs are looked up
+        once and the ones unknown locally are resolved concurrently
+        @returns A list in the same order of usernames_or_ids containing
+        either the user info dict or the UserResolverError of each lookup
+        '''
+        lookup_keys = [self._get_lookup_key(x) for x in usernames_or_ids]
+        # lookup_key -> user info dict or UserResolverError
+        results = {}
+        to_resolve = {}
+        for username_or_id, lookup_key in zip(usernames_or_ids, lookup_keys):
+            if lookup_key in results or lookup_key in to_resolve:
+                continue
+            try:
+                results[lookup_key] = self._get_local_user_info(
+                    username_or_id, lookup_key)
+            except KeyError:
+                to_resolve[lookup_key] = username_or_id
+            except UserResolverError as e:
+                results[lookup_key] = e
+
+        if to_resolve:
+            logger.debug(f'Resolving {len(to_resolve)} users through '
+                         'telegram')
+            # The lookups run in waves of at most MaxConcurrentLookups
+            timeout = self._request_timeout * \
+                ceil(len(to_resolve) / self._max_concurrent_lookups)
+            try:
+                entities = self._call(self._get_entities,
+                                      list(to_resolve.values()),
+                                      timeout=timeout)
+            except UserResolverError as e:
+                entities = [e] * len(to_resolve)
+
+            for lookup_key, entity in zip(to_resolve, entities):
+                results[lookup_key] = self._entity_to_user_info_or_error(
+                    lookup_key, entity)
+
+        return [results[x] for x in lookup_keys]
+
+    def _entity_to_user_info_or_error(self, lookup_key: str, entity):
+        if isinstance(entity, UserResolverError):
+            return entity
+        elif isinstance(entity, ValueError):
+            self._cache_user_info(lookup_key)
+            return UserResolverError('Invalid username/user_id')
+        elif isinstance(entity, FloodWaitError):
+            self._open_circuit(entity.seconds)
+            return UserResolverError('Username resolution is temporarily '
+                                     'unavailable, retry in '
+                                     f'{entity.seconds}s')
+        elif isinstance(entity, Exception):
+            logger.warning(f'Could not resolve {lookup_key}: {entity}')
+            return UserResolverError('Username resolution failed')
+
+        info = self._entity_to_user_info(entity)
+        self._cache_user_info(lookup_key, info)
+        return info
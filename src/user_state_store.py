@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+#
+# anon_chat_bot is a telegram bot whose main function is to manage an
+# anonymous chat lounge
+# Copyright (C) <2020>  <jacotsu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import Iterable
+import numpy as np
+from permissions import Permissions
+
+
+logger = logging.getLogger(__name__)
+
+
+class UserStateStore:
+    '''
+    An in-memory columnar copy of the users' state. Every column is a numpy
+    array and each user occupies the same row in all of them, this allows
+    selecting the recipients of a message with a single vectorized
+    expression instead of querying the database for every user.
+    The store is kept up to date by the DatabaseManager's writes
+    '''
+    _initial_capacity = 1024
+    _column_names = ('_user_ids', '_permissions', '_role_power', '_member',
+                     '_banned_until', '_captcha_passed')
+
+    def __init__(self, capacity: int = _initial_capacity):
+        self._lock = threading.Lock()
+        # user_id -> row
+        self._rows = {}
+        self._size = 0
+        self._user_ids = np.zeros(capacity, dtype=np.int64)
+        # Permissions fit in 63 bits, a signed integer avoids the numpy
+        # uint64/python int promotion pitfalls
+        self._permissions = np.zeros(capacity, dtype=np.int64)
+        self._role_power = np.zeros(capacity, dtype=np.int64)
+        self._member = np.zeros(capacity, dtype=bool)
+        # Unix timestamp (seconds) until which the user is banned
+        self._banned_until = np.zeros(capacity, dtype=np.int64)
+        self._captcha_passed = np.zeros(capacity, dtype=bool)
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, user_id):
+        return user_id in self._rows
+
+    def _grow(self):
+        '''
+        Doubles the capacity of every column, must be called with the lock
+        held
+        '''
+        new_capacity = 2*len(self._user_ids)
+        for column_name in self._column_names:
+            column = getattr(self, column_name)
+            new_column = np.zeros(new_capacity, dtype=column.dtype)
+            new_column[:self._size] = column[:self._size]
+            setattr(self, column_name, new_column)
+        logger.debug(f'User state store grown to {new_capacity} rows')
+
+    def _get_or_create_row(self, user_id: int) -> int:
+        '''
+        Must be called with the lock held
+        '''
+        try:
+            return self._rows[user_id]
+        except KeyError:
+            if self._size == len(self._user_ids):
+                self._grow()
+            row = self._size
+            self._user_ids[row] = user_id
+            self._permissions[row] = 0
+            self._role_power[row] = 0
+            self._member[row] = False
+            self._banned_until[row] = 0
+            self._captcha_passed[row] = False
+            self._rows[user_id] = row
+            self._size += 1
+            return row
+
+    def _set(self, column_name: str, user_id: int, value):
+        with self._lock:
+            row = self._get_or_create_row(user_id)
+            getattr(self, column_name)[row] = value
+
+    def load(self, rows: Iterable):
+        '''
+        Loads (or refreshes) the state of the users from database rows with
+        the user_id, permissions, role_power, member, unix_banned_until and
+        captcha_passed columns
+        '''
+        count = 0
+        for row in rows:
+            self.upsert(
+                row['user_id'],
+                permissions=row['permissions'],
+                role_power=row['role_power'],
+                member=row['member'],
+                banned_until=row['unix_banned_until'],
+                captcha_passed=row['captcha_passed']
+            )
+            count += 1
+        logger.debug(f'Loaded the state of {count} users')
+
+    def upsert(self,
+               user_id: int,
+               permissions: Permissions = Permissions.NONE,
+               role_power: int = 0,
+               member: bool = False,
+               banned_until: int = 0,
+               captcha_passed: bool = False):
+        with self._lock:
+            row = self._get_or_create_row(user_id)
+            self._permissions[row] = int(permissions)
+            self._role_power[row] = int(role_power)
+            self._member[row] = bool(member)
+            self._banned_until[row] = int(banned_until)
+            self._captcha_passed[row] = bool(captcha_passed)
+
+    def set_permissions(self, user_id: int, permissions: Permissions):
+        self._set('_permissions', user_id, int(permissions))
+
+    def set_role_power(self, user_id: int, power: int):
+        self._set('_role_power', user_id, int(power))
+
+    def set_member(self, user_id: int, is_member: bool):
+        self._set('_member', user_id, bool(is_member))
+
+    def set_banned_until(self, user_id: int, unix_date: int):
+        self._set('_banned_until', user_id, int(unix_date))
+
+    def set_captcha_passed(self, user_id: int, passed: bool):
+        self._set('_captcha_passed', user_id, bool(passed))
+
+    def get_permissions(self, user_id: int) -> Permissions:
+        '''
+        @raises KeyError if the user is not in the store
+        '''
+        with self._lock:
+            return Permissions(int(self._permissions[self._rows[user_id]]))
+
+    def get_role_power(self, user_id: int) -> int:
+        '''
+        @raises KeyError if the user is not in the store
+        '''
+        with self._lock:
+            return int(self._role_power[self._rows[user_id]])
+
+    def get_state(self, user_id: int) -> dict:
+        '''
+        @returns The user's permissions, role_power, member, banned_until
+        and captcha_passed
+        @raises KeyError if the user is not in the store
+        '''
+        with self._lock:
+            row = self._rows[user_id]
+            return {
+                'permissions': Permissions(int(self._permissions[row])),
+                'role_power': int(self._role_power[row]),
+                'member': bool(self._member[row]),
+                'banned_until': int(self._banned_until[row]),
+                'captcha_passed': bool(self._captcha_passed[row])
+            }
+
+    def select_active(self,
+                      required: Permissions = Permissions.NONE,
+                      now: datetime = None) -> np.ndarray:
+        '''
+        @returns The ids of the active users (members that passed the captcha
+        and are not banned) whose permissions include the required ones
+        '''
+        if not now:
+            now = datetime.utcnow()
+        unix_now = int(now.replace(tzinfo=timezone.utc).timestamp())
+        required = np.int64(int(required))
+
+        with self._lock:
+            size = self._size
+            mask = (self._permissions[:size] & required) == required
+            mask &= self._member[:size]
+            mask &= self._captcha_passed[:size]
+            mask &= self._banned_until[:size] <= unix_now
+            return self._user_ids[:size][mask]
@@ -21,6 +21,9 @@
 
 import logging
 import sys
+import threading
+from time import monotonic
+from collections import OrderedDict
 from math import ceil
 from enum import EnumMeta
 from operator import or_ as _or_
@@ -160,6 +163,89 @@ class SingletonDecorator:
             self.instance = self.klass(*args, **kwds)
         return self.instance
 
+class LRUCache:
+    '''
+    A thread safe least recently used cache whose entries optionally expire
+    after ttl seconds
+    '''
+    def __init__(self, maxsize: int = 1024, ttl: float = None):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (value, expiration time)
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        '''
+        @raises KeyError if the key is missing or expired
+        '''
+        with self._lock:
+            value, expiration_time = self._data[key]
+            if expiration_time is not None and expiration_time < monotonic():
+                del self._data[key]
+                raise KeyError(key)
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value, ttl: float = None):
+        '''
+        Stores the value, ttl overrides the cache's default time to live
+        '''
+        ttl = self._ttl if ttl is None else ttl
+        expiration_time = monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expiration_time)
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                return self._data.pop(key)[0]
+            except KeyError:
+                return default
+
+    def add(self, key, value, ttl: float = None) -> bool:
+        '''
+        Stores the value only if the key is missing or expired
+        @returns True if the value has been stored
+        '''
+        ttl = self._ttl if ttl is None else ttl
+        now = monotonic()
+        with self._lock:
+            try:
+                expiration_time = self._data[key][1]
+                if expiration_time is None or expiration_time >= now:
+                    self._data.move_to_end(key)
+                    return False
+            except KeyError:
+                pass
+            self._data[key] = (value, now + ttl if ttl is not None else None)
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+            return True
+
+    def expire(self) -> int:
+        '''
+        Removes all the expired entries
+        @returns The number of removed entries
+        '''
+        now = monotonic()
+        with self._lock:
+            expired_keys = [
+                key for key, (_, expiration_time) in self._data.items()
+                if expiration_time is not None and expiration_time < now
+            ]
+            for key in expired_keys:
+                del self._data[key]
+        return len(expired_keys)
+
+
 def split_cmd_line(cmd_line):
     return " ".join(cmd_line.split()[1:]).split(',')
 